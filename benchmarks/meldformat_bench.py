@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Benchmarks of meldformat on synthetic source trees, each case runs in a separate process to measure its peak RSS
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import tempfile
+import argparse
+import subprocess
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+sys.path.insert(0, Path(__file__).resolve().parents[1].__str__())
+import meldformat  # noqa: E402
+
+
+LANGUAGES = {'python': meldformat.Formatter.AUTOPEP8, 'c': meldformat.Formatter.CLANGFORMAT}
+CASES = ('collect_files', 'format_file', 'format_dir', 'format_dir_meld')
+FILES_PER_DIR = 20
+FORMAT_FILE_SAMPLE_SIZE = 20
+DEFAULT_TOLERANCE = 0.2
+
+
+def generate_tree(path, language, files_count, lines_count, messiness, seed=0):
+    # Messiness is the probability that a generated statement is written badly formatted
+    rand = random.Random(seed)
+    extension, generate_source = {'python': ('.py', _generate_python_source),
+                                  'c': ('.c', _generate_c_source)}[language]
+    for i in range(files_count):
+        dir_path = path / f'package{i // FILES_PER_DIR}'
+        dir_path.mkdir(parents=True, exist_ok=True)
+        (dir_path / f'module{i}{extension}').write_text(generate_source(rand, lines_count, messiness))
+
+
+def _generate_python_source(rand, lines_count, messiness):
+    lines = ['import os', 'import sys', '', '']
+    while lines.__len__() < lines_count:
+        i = lines.__len__()
+        is_messy = rand.random() < messiness
+        lines.append(f'def function{i}(a,b = {i}):' if is_messy else f'def function{i}(a, b={i}):')
+        lines.append(f'    values=[a,b,{i}]' if rand.random() < messiness else f'    values = [a, b, {i}]')
+        lines.append('    if a>b :  return sum( values )' if rand.random() < messiness else
+                     '    if a > b:\n        return sum(values)')
+        lines.append('    return {"a":a, "b":b}' if rand.random() < messiness else "    return {'a': a, 'b': b}")
+        lines.extend(('', ''))
+    
+    return '\n'.join(lines) + '\n'
+
+
+def _generate_c_source(rand, lines_count, messiness):
+    lines = ['#include <stdio.h>', '']
+    while lines.__len__() < lines_count:
+        i = lines.__len__()
+        lines.append(f'int function{i}(int a,int b){{' if rand.random() < messiness else
+                     f'int function{i}(int a, int b) {{')
+        lines.append(f'  int values[3]={{a,b,{i}}};' if rand.random() < messiness else
+                     f'  int values[3] = {{a, b, {i}}};')
+        lines.append('  if(a>b) return values[0]+values[1];' if rand.random() < messiness else
+                     '  if (a > b)\n    return values[0] + values[1];')
+        lines.append('  return values[2];}' if rand.random() < messiness else '  return values[2];\n}')
+        lines.append('')
+    
+    return '\n'.join(lines) + '\n'
+
+
+def run_case(case, language, tree_path, jobs):
+    formatter = LANGUAGES[language]
+    timing_collector = meldformat.TimingCollector()
+    files_paths = sorted(meldformat._collect_files_to_format(formatter.value(), tree_path))
+    bytes_count = sum(file_path.stat().st_size for file_path in files_paths)
+    
+    start_time = time.perf_counter()
+    if case == 'collect_files':
+        list(meldformat._collect_files_to_format(formatter.value(), tree_path))
+    elif case == 'format_file':
+        files_paths = files_paths[:FORMAT_FILE_SAMPLE_SIZE]
+        bytes_count = sum(file_path.stat().st_size for file_path in files_paths)
+        start_time = time.perf_counter()
+        for file_path in files_paths:
+            meldformat.format_file(formatter, file_path, with_meld=False)
+    elif case == 'format_dir':
+        meldformat.format_dir(formatter, tree_path, with_meld=False, jobs=jobs, hooks=(timing_collector,))
+    elif case == 'format_dir_meld':
+        # Meld is interactive so merging is simulated by accepting all the changes
+        meldformat._check_meld = lambda: None
+        meldformat._merge_changes = lambda original_file_path, formatted_file_path: \
+            shutil.copy(formatted_file_path, original_file_path)
+        meldformat.format_dir(formatter, tree_path, with_meld=True, jobs=jobs, hooks=(timing_collector,))
+    elapsed_time = time.perf_counter() - start_time
+    
+    return {'elapsed_time': elapsed_time,
+            'files': files_paths.__len__(),
+            'bytes': bytes_count,
+            'files_per_second': files_paths.__len__() / elapsed_time,
+            'megabytes_per_second': bytes_count / elapsed_time / 2 ** 20,
+            'peak_rss': _get_peak_rss(),
+            'phases_times': {phase.value: phase_time for phase, phase_time in timing_collector.phases_times.items()}}
+
+
+def _get_peak_rss():
+    # Workers peak is the peak of the largest finished child process
+    if resource is None:
+        return None
+    
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {'main': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            'workers': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+
+def run_benchmarks(languages, cases, files_count, lines_count, messiness, repeat, jobs):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='meldformat_bench_') as work_dir:
+        for language in languages:
+            if language == 'c' and shutil.which('clang-format') is None:
+                print('Clang-Format not found, C benchmarks skipped.', file=sys.stderr)
+                continue
+            source_tree_path = Path(work_dir) / f'{language}_source'
+            generate_tree(source_tree_path, language, files_count, lines_count, messiness)
+            for case in cases:
+                runs = []
+                for _ in range(repeat):
+                    # Formatting changes the files so each run gets a fresh copy of the tree
+                    tree_path = Path(work_dir) / f'{language}_tree'
+                    shutil.copytree(source_tree_path, tree_path)
+                    runs.append(_run_case_in_process(case, language, tree_path, jobs, Path(work_dir)))
+                    shutil.rmtree(tree_path)
+                result = min(runs, key=lambda run: run['elapsed_time'])
+                results[f'{language}.{case}'] = result
+                print(f'{language}.{case}: {result["elapsed_time"]:.3f} s, {result["files_per_second"]:.1f} files/s, '
+                      f'{result["megabytes_per_second"]:.2f} MB/s', file=sys.stderr)
+    
+    return results
+
+
+def _run_case_in_process(case, language, tree_path, jobs, work_dir):
+    result_path = work_dir / 'result.json'
+    args = [sys.executable, __file__, '--run-case', case, '--language', language, '--tree', tree_path.__str__(),
+            '--result', result_path.__str__()]
+    if jobs is not None:
+        args.extend(('--jobs', jobs.__str__()))
+    # Linter findings are printed so the output of the case is dropped
+    subprocess.run(args, stdout=subprocess.DEVNULL, check=True)
+    
+    return json.loads(result_path.read_text())
+
+
+def compare_with_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        ratio = result['elapsed_time'] / baseline[key]['elapsed_time']
+        print(f'{key}: {ratio:.2f}x of the baseline time', file=sys.stderr)
+        if ratio > 1 + tolerance:
+            regressions.append(key)
+    
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark meldformat on synthetic source trees.')
+    parser.add_argument('--languages', nargs='+', default=list(LANGUAGES), choices=list(LANGUAGES))
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=CASES)
+    parser.add_argument('--files', type=int, default=200, help='number of files in a tree')
+    parser.add_argument('--lines', type=int, default=200, help='number of lines in a file')
+    parser.add_argument('--messiness', type=float, default=0.5, help='fraction of badly formatted statements')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the fastest one is reported')
+    parser.add_argument('-j', '--jobs', type=int, help='number of parallel jobs, by default the CPU count')
+    parser.add_argument('-o', '--output', help='save results to a JSON file')
+    parser.add_argument('--baseline', help='compare results with a JSON file saved by --output')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed slowdown against the baseline, exit with code 1 above it')
+    parser.add_argument('--run-case', choices=CASES, help=argparse.SUPPRESS)
+    parser.add_argument('--language', choices=list(LANGUAGES), help=argparse.SUPPRESS)
+    parser.add_argument('--tree', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+    
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    if args.run_case:
+        result = run_case(args.run_case, args.language, Path(args.tree), args.jobs)
+        Path(args.result).write_text(json.dumps(result))
+        return 0
+    
+    results = run_benchmarks(args.languages, args.cases, args.files, args.lines, args.messiness, args.repeat,
+                             args.jobs)
+    if args.output:
+        Path(args.output).write_text(json.dumps({'meldformat': meldformat.__version__,
+                                                 'python': platform.python_version(),
+                                                 'platform': platform.platform(),
+                                                 'cpu_count': os.cpu_count(),
+                                                 'args': vars(args),
+                                                 'results': results}, indent=4))
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())['results']
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f'Slower than the baseline: {", ".join(regressions)}', file=sys.stderr)
+            return 1
+    
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,4 @@
 collect_ignore = [
     'setup.py',
+    'benchmarks',
 ]
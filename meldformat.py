@@ -2,24 +2,95 @@
 # -*- coding: utf-8 -*-
 
 
+import io
 import os
+import sys
+import re
+import ast
+import copy
+import stat
 import shutil
 import logging
 import tempfile
 import filecmp
+import json
+import uuid
+import time
+import dataclasses
+import cProfile
+import signal
+import socket
+import threading
+import socketserver
+import hashlib
+import difflib
+import argparse
+import tokenize
 import autopep8
+import pycodestyle
+import configparser
+import importlib.util
+import contextlib
+import collections
+import functools
 import subprocess
+import meldformat_client
 from types import SimpleNamespace
-from itertools import chain
+from itertools import chain, islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from enum import Enum
 
+try:
+    import pyflakes.checker
+except ImportError:
+    pyflakes = None
+
 
 __author__ = 'Damian Pala'
 __version__ = '0.0.1'
 
 
 _logger = logging.getLogger(__name__)
+_flake8_pycodestyle = None
+# Caches of the formatters used by a worker process, by the caches id of a formatter
+_worker_caches = {}
+
+CACHE_FILE_NAME = '.meldformat_cache'
+LINT_CACHE_FILE_NAME = '.meldformat_lint_cache'
+CACHE_MAX_ENTRIES = 100000
+IGNORE_FILES_NAMES = ('.gitignore', '.meldformatignore')
+COMPARE_CHUNK_SIZE = 64 * 1024
+# Conservative limit that fits the Windows command line length
+MAX_CMD_LENGTH = 30000
+# Seconds after a formatter or a linter process is killed, Meld is interactive and has no timeout
+CMD_TIMEOUT = 300
+MAX_PENDING_FILES_PER_JOB = 2
+MAX_LINT_BATCH_SIZE = 2000
+MELD_MAX_TABS = 10
+DEFAULT_EXCLUDES = ('.git/', '.hg/', '.svn/', '.tox/', '.nox/', '.venv/', 'venv/', 'node_modules/', '__pycache__/')
+# Codes the Flake8 gives to the Pyflakes messages
+PYFLAKES_CODES = {
+    'UnusedImport': 'F401', 'ImportShadowedByLoopVar': 'F402', 'ImportStarUsed': 'F403', 'LateFutureImport': 'F404',
+    'ImportStarUsage': 'F405', 'ImportStarNotPermitted': 'F406', 'FutureFeatureNotDefined': 'F407',
+    'PercentFormatInvalidFormat': 'F501', 'PercentFormatExpectedMapping': 'F502',
+    'PercentFormatExpectedSequence': 'F503', 'PercentFormatExtraNamedArguments': 'F504',
+    'PercentFormatMissingArgument': 'F505', 'PercentFormatMixedPositionalAndNamed': 'F506',
+    'PercentFormatPositionalCountMismatch': 'F507', 'PercentFormatStarRequiresSequence': 'F508',
+    'PercentFormatUnsupportedFormatCharacter': 'F509', 'StringDotFormatInvalidFormat': 'F521',
+    'StringDotFormatExtraNamedArguments': 'F522', 'StringDotFormatExtraPositionalArguments': 'F523',
+    'StringDotFormatMissingArgument': 'F524', 'StringDotFormatMixingAutomatic': 'F525',
+    'FStringMissingPlaceholders': 'F541', 'TStringMissingPlaceholders': 'F542',
+    'MultiValueRepeatedKeyLiteral': 'F601', 'MultiValueRepeatedKeyVariable': 'F602',
+    'TooManyExpressionsInStarredAssignment': 'F621', 'TwoStarredExpressions': 'F622', 'AssertTuple': 'F631',
+    'IsLiteral': 'F632', 'InvalidPrintSyntax': 'F633', 'IfTuple': 'F634', 'BreakOutsideLoop': 'F701',
+    'ContinueOutsideLoop': 'F702', 'YieldOutsideFunction': 'F704', 'ReturnOutsideFunction': 'F706',
+    'DefaultExceptNotLast': 'F707', 'DoctestSyntaxError': 'F721', 'ForwardAnnotationSyntaxError': 'F722',
+    'RedefinedWhileUnused': 'F811', 'UndefinedName': 'F821', 'UndefinedExport': 'F822', 'UndefinedLocal': 'F823',
+    'UnusedIndirectAssignment': 'F824', 'DuplicateArgument': 'F831', 'UnusedVariable': 'F841',
+    'UnusedAnnotation': 'F842', 'RaiseNotImplemented': 'F901',
+}
+NOQA_REGEX = re.compile(r'# noqa(?::[\s]?(?P<codes>([A-Z][0-9]+(?:[,\s]+)?)+))?', re.IGNORECASE)
 
 
 class MeldFormatError(Exception):
@@ -60,92 +131,1032 @@ class ClangFormatError(MeldFormatError):
     pass
 
 
+class GitError(MeldFormatError):
+    pass
+
+
+class LintBackendNotSpecifiedError(MeldFormatError):
+    pass
+
+
+class LinterNotFoundError(MeldFormatError):
+    pass
+
+
+class ServerError(MeldFormatError):
+    pass
+
+
+class LintError(MeldFormatError):
+    pass
+
+
+class DiffError(MeldFormatError):
+    pass
+
+
 class Autopep8Formatter():
     name = 'Autopep8'
     linter = SimpleNamespace(name='Flake8', cmd='flake8')
     sources_extensions = ['.py']
+    
+    def __init__(self):
+        self.lint_backend = LintBackend.SUBPROCESS
+        # Parsed options belong to the instance, workers find their own copies again by the caches id
+        self._caches_id = uuid.uuid4().hex
+        self._options_cache = {}
+        self._config_dirs_cache = {}
+        self._lint_options_cache = {}
+        # Server threads share the formatter
+        self._caches_lock = threading.RLock()
+    
+    def __getstate__(self):
+        # Caches are not sent with each file to a worker, the worker keeps them between files instead
+        state = self.__dict__.copy()
+        for name in ('_options_cache', '_config_dirs_cache', '_lint_options_cache', '_caches_lock'):
+            del state[name]
+        
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        caches = _worker_caches.setdefault(self._caches_id, ({}, {}, {}, threading.RLock()))
+        self._options_cache, self._config_dirs_cache, self._lint_options_cache, self._caches_lock = caches
 
-    def format_file(self, file_to_format_path, setup_path):
-        if setup_path is None:
-            options = None
-        else:
-            options = autopep8.parse_args(('--global-config='+setup_path.__str__(),
-                                           file_to_format_path.__str__()), apply_config=True)
+    def format_file(self, file_to_format_path, setup_path, line_ranges=None, work_dir=None):
         temp_fd, temp_path = tempfile.mkstemp(prefix=f'{file_to_format_path.stem}_', 
                                               suffix=file_to_format_path.suffix, 
-                                              text=True)
-        with os.fdopen(temp_fd, 'w') as file:
-            autopep8.fix_file(file_to_format_path.__str__(), output=file, options=options)
+                                              dir=work_dir, text=True)
+        if line_ranges is None:
+            options = self._get_options(file_to_format_path, setup_path)
+            with os.fdopen(temp_fd, 'w') as file:
+                autopep8.fix_file(file_to_format_path.__str__(), output=file, options=options)
+        else:
+            source, encoding = _read_source(file_to_format_path)
+            with os.fdopen(temp_fd, 'w', encoding=encoding, newline='') as file:
+                file.write(self.format_code(source, file_to_format_path, setup_path, line_ranges))
             
         return Path(temp_path)
     
+    def get_version(self):
+        return autopep8.__version__
+    
+    def format_code(self, source, file_to_format_path, setup_path, line_ranges=None):
+        if line_ranges is None:
+            return autopep8.fix_code(source, options=self._get_options(file_to_format_path, setup_path))
+        
+        # Ranges are fixed from the bottom so changed lines count does not shift the ranges above
+        for start, end in sorted(line_ranges, reverse=True):
+            options = self._get_options(file_to_format_path, setup_path) or autopep8.parse_args([''])
+            options.line_range = [start, end]
+            source = autopep8.fix_code(source, options=options)
+        
+        return source
+    
+    def _get_options(self, file_to_format_path, setup_path, use_cache=True):
+        if setup_path is None:
+            return None
+        
+        if not use_cache:
+            return self._parse_options(file_to_format_path, setup_path)
+        
+        # Configs may change while the server keeps the formatter, so their modification times are in the key
+        with self._caches_lock:
+            key = (setup_path, _get_mtime(setup_path), self.get_config_state(file_to_format_path, setup_path))
+            if key not in self._options_cache:
+                self._options_cache[key] = self._parse_options(file_to_format_path, setup_path)
+            
+            # autopep8 reassigns options attributes while fixing so each file gets its own copy
+            return copy.copy(self._options_cache[key])
+    
+    def _parse_options(self, file_to_format_path, setup_path):
+        return autopep8.parse_args(('--global-config='+setup_path.__str__(),
+                                    file_to_format_path.__str__()), apply_config=True)
+    
+    def get_config_state(self, file_path, setup_path):
+        # Local config files are read only together with a setup file, they change the output of the file then
+        if setup_path is None:
+            return None
+        
+        with self._caches_lock:
+            return (self._get_config_state(file_path.parent, autopep8.PROJECT_CONFIG),
+                    self._get_config_state(file_path.parent, ('pyproject.toml',)))
+    
+    def _get_config_state(self, directory, config_files_names):
+        config_dir = self._find_config_dir(directory, config_files_names)
+        if config_dir is None:
+            return None
+        
+        return config_dir, tuple(_get_mtime(config_dir / name) for name in config_files_names)
+    
+    def _find_config_dir(self, directory, config_files_names):
+        # Directory modification time changes when a config file is added or removed there
+        key = (directory, config_files_names, _get_mtime(directory))
+        if key not in self._config_dirs_cache:
+            if any((directory / name).exists() for name in config_files_names):
+                self._config_dirs_cache[key] = directory
+            elif directory.parent == directory:
+                self._config_dirs_cache[key] = None
+            else:
+                self._config_dirs_cache[key] = self._find_config_dir(directory.parent, config_files_names)
+        
+        return self._config_dirs_cache[key]
+    
     def lint_file(self, file_to_lint_path, setup_path):
         _logger.info(f'Lint {file_to_lint_path} file and show report.')
         _logger.info(f'=============== {file_to_lint_path.name} ===============')
 
+        if self.lint_backend == LintBackend.IN_PROCESS:
+            findings = self.lint_code(_read_source(file_to_lint_path)[0], file_to_lint_path, setup_path)
+            if findings:
+                return '\n'.join(findings)
+            _logger.info('File is OK!')
+            return None
+        
         if not shutil.which(self.linter.cmd):
             raise MeldError(f'{self.linter.name} not found. Please install it and add to PATH', _logger)
 
-        try:
-            if setup_path is None:
-                _execute_cmd((Autopep8Formatter.linter.cmd, 
-                              file_to_lint_path.__str__()))
+        config_args = () if setup_path is None else (f'--config={setup_path}',)
+        output, = _execute_cmds(((Autopep8Formatter.linter.cmd, file_to_lint_path.__str__(), *config_args),))
+        if isinstance(output, ExecuteCmdError):
+            return output.__str__()
+        
+        _logger.info('File is OK!')
+    
+    def lint_files(self, files_to_lint_paths, setup_path, jobs):
+        if self.lint_backend == LintBackend.IN_PROCESS:
+            return {file: findings if error is None else LintError(error, _logger)
+                    for file, findings, error, _ in _iter_mapped_files(_lint_file_in_process, self,
+                                                                       files_to_lint_paths, setup_path, jobs)}
+        
+        if not shutil.which(self.linter.cmd):
+            raise MeldError(f'{self.linter.name} not found. Please install it and add to PATH', _logger)
+        
+        config_args = () if setup_path is None else (f'--config={setup_path}',)
+        files_by_names = {file_to_lint_path.__str__(): file_to_lint_path for file_to_lint_path in files_to_lint_paths}
+        reports = {file_to_lint_path: [] for file_to_lint_path in files_to_lint_paths}
+        chunks = list(_split_into_chunks(files_to_lint_paths, sys.maxsize, MAX_CMD_LENGTH,
+                                         lambda file: file.__str__().__len__() + 1))
+        # Chunks run at once so the jobs are shared between them
+        chunk_jobs = max(1, jobs // max(1, chunks.__len__()))
+        outputs = _execute_cmds([(self.linter.cmd, f'--jobs={chunk_jobs}', '--format=default', *config_args,
+                                  *(file.__str__() for file in chunk)) for chunk in chunks], jobs)
+        # A failed file gets the error instead of the findings
+        for chunk, output in zip(chunks, outputs):
+            other_lines = []
+            for line in output.__str__().splitlines():
+                match = re.match(r'(.*?):\d+:\d+: ', line)
+                if match and match.group(1) in files_by_names:
+                    reports[files_by_names[match.group(1)]].append(line)
+                elif line.strip():
+                    other_lines.append(line)
+            if isinstance(output, ExecuteCmdError) and other_lines:
+                # Findings alone also end Flake8 with an error, other lines mean that the run itself failed
+                error = LintError(f'{self.linter.name} failed: {other_lines[-1].strip()}', _logger)
+                reports.update((file, error) for file in chunk)
             else:
-                _execute_cmd((Autopep8Formatter.linter.cmd, 
-                              file_to_lint_path.__str__(), 
-                              f'--config={setup_path}'))
-        except ExecuteCmdError as e:
-            return e.__str__()
+                for line in other_lines:
+                    _logger.error(f'{self.linter.name}: {line}')
+        
+        return reports
+    
+    def get_linter_version(self):
+        if self.lint_backend == LintBackend.IN_PROCESS:
+            return f'pycodestyle {pycodestyle.__version__}, pyflakes {getattr(pyflakes, "__version__", None)}'
+        
+        return _execute_cmd((self.linter.cmd, '--version')).strip()
+    
+    def lint_code(self, source, file_to_lint_path, setup_path):
+        if pyflakes is None:
+            raise LinterNotFoundError('Pyflakes not found. Please install it to lint in process', _logger)
+        
+        select, ignore, style_options = self._get_lint_options(setup_path)
+        filename = file_to_lint_path.__str__()
+        lines = source.splitlines(True)
+        try:
+            tree = ast.parse(source, filename)
+        except SyntaxError as e:
+            # The same as Flake8, other checks make no sense for a file that cannot be parsed
+            findings = [(e.lineno or 1, (e.offset or 0) + 1, f'E999 SyntaxError: {e.msg}')]
         else:
-            _logger.info('File is OK!')
+            report = _PycodestyleReport(style_options)
+            _get_flake8_pycodestyle().Checker(filename, lines=lines, options=style_options, report=report).check_all()
+            findings = report.findings
+            for message in pyflakes.checker.Checker(tree, filename=filename).messages:
+                code = PYFLAKES_CODES.get(message.__class__.__name__, 'F999')
+                findings.append((message.lineno, message.col + 1,
+                                 f'{code} {message.message % message.message_args}'))
+        
+        findings.sort(key=lambda finding: finding[:2])
+        findings = [finding for finding in findings if self._is_code_reported(finding[2][:4], select, ignore)]
+        return [f'{filename}:{line_number}:{column}: {text}' for line_number, column, text in findings
+                if not self._is_noqa(text[:4], lines[line_number - 1] if line_number <= lines.__len__() else '')]
+    
+    def _get_lint_options(self, setup_path):
+        key = (setup_path, _get_mtime(setup_path))
+        with self._caches_lock:
+            if key not in self._lint_options_cache:
+                self._lint_options_cache[key] = self._parse_lint_options(setup_path)
+            
+            return self._lint_options_cache[key]
+    
+    def _parse_lint_options(self, setup_path):
+        # Flake8 section is parsed instead of the autopep8 options because select and ignore mean fixes there
+        config = configparser.RawConfigParser()
+        if setup_path is not None:
+            config.read(setup_path)
+        section = {}
+        if config.has_section('flake8'):
+            section = {key.replace('-', '_'): value for key, value in config.items('flake8')}
+        
+        def split_codes(option):
+            return tuple(code for code in re.split(r'[,\s]+', section.get(option, '')) if code)
+        
+        select = (split_codes('select') or ('',)) + split_codes('extend_select')
+        ignore = (split_codes('ignore') if 'ignore' in section else tuple(pycodestyle.DEFAULT_IGNORE.split(',')))
+        ignore += split_codes('extend_ignore')
+        max_doc_length = section.get('max_doc_length')
+        # All checks are run and the findings are filtered the same way Flake8 does it
+        style_options = _get_flake8_pycodestyle().StyleGuide(
+            select=('E', 'W', 'C'),
+            max_line_length=int(section.get('max_line_length', pycodestyle.MAX_LINE_LENGTH)),
+            max_doc_length=None if max_doc_length is None else int(max_doc_length),
+            hang_closing=section.get('hang_closing', '').lower() in ('1', 'yes', 'true', 'on')).options
+        
+        return select, ignore, style_options
+    
+    @staticmethod
+    def _is_code_reported(code, select, ignore):
+        # The longest matching prefix decides, the same as in Flake8
+        selected = max((prefix.__len__() for prefix in select if code.startswith(prefix)), default=-1)
+        ignored = max((prefix.__len__() for prefix in ignore if code.startswith(prefix)), default=-1)
+        return selected >= 0 and selected >= ignored
+    
+    @staticmethod
+    def _is_noqa(code, line):
+        match = NOQA_REGEX.search(line)
+        if match is None:
+            return False
+        
+        codes = match.group('codes')
+        return codes is None or code.startswith(tuple(re.split(r'[,\s]+', codes.strip().upper())))
 
 
 class ClangFormatter():
     name = 'ClangFormat'
     sources_extensions = ['.c', '.h', '.cpp', '.cxx', '.hpp', '.hxx']
+    max_batch_size = 16
+    # The style file path option is available since Clang-Format 14, checked once per process
+    _style_file_path_supported = None
+    # Directories the formatted content is assumed to be in, kept by the server for each setup file
+    _style_dirs = {}
+    # Check and diff runs keep the style directories of their own and of their workers there, see style_dirs_scope
+    style_dirs_path = None
     
-    def format_file(self, file_to_format_path, setup_path):
-        temp_file_path = Path(tempfile.mktemp(prefix=f'{file_to_format_path.stem}_', 
-                                              suffix=file_to_format_path.suffix))
-        shutil.copy(file_to_format_path, temp_file_path)
-        if setup_path is not None:
-            temp_setup_path = temp_file_path.parent / setup_path.name
-            shutil.copy(setup_path, temp_setup_path)
-            
+    def get_version(self):
         try:
-            _execute_cmd(('clang-format', '-i', temp_file_path.__str__()))
+            return _execute_cmd(('clang-format', '--version')).strip()
         except ExecuteCmdError as e:
             raise ClangFormatError(f'Error occured when run {self.name}: {e}', _logger)
-        finally:
-            if setup_path is not None:
+    
+    def format_file(self, file_to_format_path, setup_path, line_ranges=None, work_dir=None):
+        (temp_file_path, error), = self._format_files_separately((file_to_format_path,), setup_path, 1, (line_ranges,),
+                                                                 work_dir)
+        if error is not None:
+            raise ClangFormatError(f'Error occured when run {self.name}: {error}', _logger)
+
+        return temp_file_path
+    
+    def format_files_separately(self, files_to_format_paths, setup_path, jobs, files_line_ranges, work_dir=None):
+        results = self._format_files_separately(files_to_format_paths, setup_path, jobs, files_line_ranges, work_dir)
+        return [(temp_file_path, None) if error is None else
+                (None, f'{ClangFormatError.__name__}: Error occured when run {self.name}: {error}')
+                for temp_file_path, error in results]
+    
+    def _format_files_separately(self, files_to_format_paths, setup_path, jobs, files_line_ranges, work_dir=None):
+        # Each file has its own process, e.g. for its own line ranges, and up to jobs processes run at once
+        temp_files_paths = []
+        cmds_args = []
+        with contextlib.ExitStack() as stack:
+            for file_to_format_path, line_ranges in zip(files_to_format_paths, files_line_ranges):
+                # Temp file is placed in a private directory so a style file copy never collides with other runs
+                temp_dir_path = Path(tempfile.mkdtemp(prefix='meldformat_', dir=work_dir))
+                temp_file_path = temp_dir_path / file_to_format_path.name
+                shutil.copy(file_to_format_path, temp_file_path)
+                temp_files_paths.append(temp_file_path)
+                if line_ranges is not None and not line_ranges:
+                    cmds_args.append(None)
+                    continue
+                
+                lines_args = [] if line_ranges is None else [f'--lines={start}:{end}' for start, end in line_ranges]
+                style_args = stack.enter_context(self._resolve_style(setup_path, temp_dir_path))
+                cmds_args.append(('clang-format', *style_args, *lines_args, '-i', temp_file_path.__str__()))
+            outputs = iter(_execute_cmds([args for args in cmds_args if args is not None], jobs))
+        
+        results = []
+        for temp_file_path, args in zip(temp_files_paths, cmds_args):
+            output = None if args is None else next(outputs)
+            if isinstance(output, ExecuteCmdError):
+                shutil.rmtree(temp_file_path.parent, ignore_errors=True)
+                results.append((None, output))
+            else:
+                results.append((temp_file_path, None))
+        
+        return results
+    
+    def format_files(self, files_to_format_paths, setup_path, work_dir):
+        work_dir.mkdir(parents=True, exist_ok=True)
+        # Each file keeps its name, the same as in the single file mode, in its own directory
+        temp_files_paths = [work_dir / f'{i}' / file_to_format_path.name
+                            for i, file_to_format_path in enumerate(files_to_format_paths)]
+        for file_to_format_path, temp_file_path in zip(files_to_format_paths, temp_files_paths):
+            temp_file_path.parent.mkdir()
+            shutil.copy(file_to_format_path, temp_file_path)
+        
+        with self._resolve_style(setup_path, work_dir) as style_args:
+            try:
+                _execute_cmd(('clang-format', *style_args, '-i', *(path.__str__() for path in temp_files_paths)))
+            except ExecuteCmdError:
+                # Format one by one to find out which files cannot be formatted
+                results = []
+                for file_to_format_path, temp_file_path in zip(files_to_format_paths, temp_files_paths):
+                    shutil.copy(file_to_format_path, temp_file_path)
+                    try:
+                        _execute_cmd(('clang-format', *style_args, '-i', temp_file_path.__str__()))
+                    except ExecuteCmdError as e:
+                        results.append((None, f'{ClangFormatError.__name__}: Error occured when run {self.name}: {e}'))
+                    else:
+                        results.append((temp_file_path, None))
+                return results
+        
+        return [(temp_file_path, None) for temp_file_path in temp_files_paths]
+    
+    def format_content(self, content, file_name, setup_path, line_ranges=None):
+        # Content goes through stdin and the assumed file path gives the language and the style file location
+        style_args = ()
+        if setup_path is not None and self._is_style_file_path_supported():
+            style_args = (f'--style=file:{setup_path}',)
+        lines_args = [] if line_ranges is None else [f'--lines={start}:{end}' for start, end in line_ranges]
+        assumed_file_path = self._get_style_dir(setup_path) / file_name
+        try:
+            formatted_content, _ = _run_cmd(('clang-format', *style_args, *lines_args,
+                                             f'--assume-filename={assumed_file_path}'), input=content)
+        except ExecuteCmdError as e:
+            raise ClangFormatError(f'Error occured when run {self.name}: {e}', _logger)
+        
+        return formatted_content
+    
+    def _get_style_dir(self, setup_path):
+        # Style file copy is needed only by older Clang-Format, it is refreshed when the setup file changes
+        if setup_path is None or self._is_style_file_path_supported():
+            return Path(tempfile.gettempdir())
+        
+        key = (self.style_dirs_path, setup_path, setup_path.stat().st_mtime_ns)
+        if key not in self._style_dirs:
+            style_dir_path = Path(tempfile.mkdtemp(prefix='meldformat_style_', dir=self.style_dirs_path))
+            shutil.copy(setup_path, style_dir_path / setup_path.name)
+            self._style_dirs[key] = style_dir_path
+        
+        return self._style_dirs[key]
+    
+    @contextlib.contextmanager
+    def style_dirs_scope(self):
+        # Only the server keeps its style directories, a run removes them together with its directory
+        if self._is_style_file_path_supported():
+            yield
+            return
+        
+        with tempfile.TemporaryDirectory(prefix='meldformat_style_') as style_dirs_path:
+            self.style_dirs_path = Path(style_dirs_path)
+            try:
+                yield
+            finally:
+                for key in [key for key in self._style_dirs if key[0] == self.style_dirs_path]:
+                    del self._style_dirs[key]
+                self.style_dirs_path = None
+    
+    @contextlib.contextmanager
+    def _resolve_style(self, setup_path, temp_dir_path):
+        if setup_path is None:
+            yield ()
+        elif self._is_style_file_path_supported():
+            yield (f'--style=file:{setup_path}',)
+        else:
+            # Older Clang-Format looks for the style file only in the formatted file parent directories
+            temp_setup_path = temp_dir_path / setup_path.name
+            shutil.copy(setup_path, temp_setup_path)
+            try:
+                yield ()
+            finally:
                 temp_setup_path.unlink()
+    
+    def _is_style_file_path_supported(self):
+        if ClangFormatter._style_file_path_supported is None:
+            match = re.search(r'version (\d+)', self.get_version())
+            ClangFormatter._style_file_path_supported = match is not None and int(match.group(1)) >= 14
+        
+        return ClangFormatter._style_file_path_supported
+    
+
+def _get_flake8_pycodestyle():
+    # Autopep8 replaces checks in the pycodestyle registry with its own ones reporting bare codes, so a separate
+    # copy of the module keeps the checks the way Flake8 runs them
+    global _flake8_pycodestyle
+    if _flake8_pycodestyle is None:
+        spec = importlib.util.find_spec('pycodestyle')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _flake8_pycodestyle = module
+    
+    return _flake8_pycodestyle
+
 
-        return Path(temp_file_path)
+class _PycodestyleReport(pycodestyle.BaseReport):
+    # Keeps findings instead of printing them
+    def __init__(self, options):
+        super().__init__(options)
+        self.findings = []
     
+    def error(self, line_number, offset, text, check):
+        self.findings.append((line_number, offset + 1, text))
+
 
 class Formatter(Enum):
     AUTOPEP8 = Autopep8Formatter
     CLANGFORMAT = ClangFormatter
 
 
+class LintBackend(Enum):
+    SUBPROCESS = 'subprocess'
+    IN_PROCESS = 'in_process'
+
+
 class PathType(Enum):
     FILE = 'file'
     DIRECTORY = 'directory'
 
 
-def format_file(formatter, path, setup_path=None, with_meld=True, get_logger=None):
+class FileStatus(Enum):
+    SKIPPED = 'skipped'
+    UNCHANGED = 'unchanged'
+    CHANGED = 'changed'
+    FAILED = 'failed'
+
+
+class Phase(Enum):
+    DISCOVER = 'discover'
+    FORMAT = 'format'
+    COMPARE = 'compare'
+    WRITE = 'write'
+    MERGE = 'merge'
+    LINT = 'lint'
+
+
+class InstrumentationHooks():
+    # File path is None for spans of the whole run, spans measured in workers are reported when they finish
+    def span_started(self, phase, file_path):
+        pass
+    
+    def span_ended(self, phase, file_path, elapsed_time):
+        pass
+
+
+class TimingCollector(InstrumentationHooks):
+    def __init__(self):
+        self.phases_times = {phase: 0.0 for phase in Phase}
+        self.phases_counts = {phase: 0 for phase in Phase}
+        self.files_times = collections.defaultdict(float)
+    
+    def span_ended(self, phase, file_path, elapsed_time):
+        self.phases_times[phase] += elapsed_time
+        self.phases_counts[phase] += 1
+        if file_path is not None:
+            self.files_times[file_path] += elapsed_time
+    
+    def get_slowest_files(self, count=10):
+        return sorted(self.files_times.items(), key=lambda file_time: file_time[1], reverse=True)[:count]
+    
+    def print_summary(self, top_files_count=10):
+        # Phases of parallel workers overlap so their times may add up to more than the run time
+        total_time = sum(self.phases_times.values())
+        print(f'{"Phase":<10}{"Spans":>10}{"Time [s]":>12}{"Share":>8}')
+        for phase in Phase:
+            share = self.phases_times[phase] / total_time if total_time else 0.0
+            print(f'{phase.value:<10}{self.phases_counts[phase]:>10}{self.phases_times[phase]:>12.3f}{share:>8.1%}')
+        if self.files_times:
+            print('Slowest files:')
+            for file_path, elapsed_time in self.get_slowest_files(top_files_count):
+                print(f'{elapsed_time:>10.3f} s  {file_path}')
+
+
+@dataclasses.dataclass
+class FileResult():
+    # Slots keep the record compact because a report holds one for each file of the tree
+    __slots__ = ('path', 'status', 'bytes_before', 'bytes_after', 'format_time', 'lint_time', 'lint_findings', 'error')
+    path: Path
+    status: FileStatus
+    bytes_before: int
+    bytes_after: int
+    format_time: float
+    lint_time: float
+    lint_findings: tuple
+    error: str
+    
+    def to_dict(self):
+        return {'path': self.path.__str__(),
+                'status': self.status.value,
+                'bytes_before': self.bytes_before,
+                'bytes_after': self.bytes_after,
+                'format_time': self.format_time,
+                'lint_time': self.lint_time,
+                'lint_findings': list(self.lint_findings),
+                'error': self.error}
+
+
+class FormatReport():
+    # Files results in the discovery order, times are in seconds
+    def __init__(self, hooks=()):
+        self._files = {}
+        self._hooks = tuple(hooks)
+        self.elapsed_time = 0.0
+    
+    def __getitem__(self, file_path):
+        return self._files[file_path]
+    
+    @property
+    def files(self):
+        return list(self._files.values())
+    
+    @property
+    def changed_files(self):
+        return [result.path for result in self._files.values() if result.status == FileStatus.CHANGED]
+    
+    def add_file(self, file_path):
+        size = file_path.stat().st_size
+        self._files[file_path] = FileResult(file_path, FileStatus.SKIPPED, size, size, 0.0, 0.0, (), None)
+    
+    def record_format(self, file_path, format_time, error):
+        result = self._files[file_path]
+        result.format_time = format_time
+        result.status = FileStatus.UNCHANGED if error is None else FileStatus.FAILED
+        result.error = error
+        self.record_span(Phase.FORMAT, file_path, format_time)
+    
+    def record_lint(self, file_path, lint_time, lint_findings):
+        # Lint findings are replaced by the error when the linter failed
+        result = self._files[file_path]
+        result.lint_time = lint_time
+        if isinstance(lint_findings, Exception):
+            result.status = FileStatus.FAILED
+            result.error = f'{lint_findings.__class__.__name__}: {lint_findings}'
+        else:
+            result.lint_findings = tuple(lint_findings)
+        self.record_span(Phase.LINT, file_path, lint_time)
+    
+    def span(self, phase, file_path=None):
+        # Hot loops stay cheap without hooks
+        return self._span(phase, file_path) if self._hooks else contextlib.nullcontext()
+    
+    def record_span(self, phase, file_path, elapsed_time):
+        for hooks in self._hooks:
+            hooks.span_started(phase, file_path)
+            hooks.span_ended(phase, file_path, elapsed_time)
+    
+    @contextlib.contextmanager
+    def _span(self, phase, file_path):
+        for hooks in self._hooks:
+            hooks.span_started(phase, file_path)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+            for hooks in self._hooks:
+                hooks.span_ended(phase, file_path, elapsed_time)
+    
+    def finish(self, elapsed_time):
+        self.elapsed_time = elapsed_time
+        for result in self._files.values():
+            if result.status == FileStatus.CHANGED:
+                result.bytes_after = result.path.stat().st_size
+    
+    def update(self, other):
+        self._files.update(other._files)
+        self.elapsed_time += other.elapsed_time
+    
+    def get_totals(self):
+        totals = {'files': self._files.__len__()}
+        totals.update((status.value, 0) for status in FileStatus)
+        totals.update(bytes_before=0, bytes_after=0, format_time=0.0, lint_time=0.0, lint_findings=0)
+        for result in self._files.values():
+            totals[result.status.value] += 1
+            totals['bytes_before'] += result.bytes_before
+            totals['bytes_after'] += result.bytes_after
+            totals['format_time'] += result.format_time
+            totals['lint_time'] += result.lint_time
+            totals['lint_findings'] += result.lint_findings.__len__()
+        totals['elapsed_time'] = self.elapsed_time
+        
+        return totals
+    
+    def to_json(self, indent=None):
+        files = [result.to_dict() for result in self._files.values()]
+        
+        return json.dumps({'totals': self.get_totals(), 'files': files}, indent=indent)
+    
+    def to_ndjson(self):
+        return ''.join(f'{json.dumps(result.to_dict())}\n' for result in self._files.values())
+
+
+class CheckResult():
+    # Files the formatting would change and files that could not be checked with their errors
+    def __init__(self):
+        self.unformatted_files = []
+        self.failed_files = {}
+        self.checked_files_count = 0
+        self.is_stopped_early = False
+    
+    @property
+    def is_formatted(self):
+        return not self.unformatted_files and not self.failed_files
+
+
+class _IgnoreRules():
+    # Gitignore style rules, each frame holds rules relative to its base directory and the last matching rule wins
+    def __init__(self, frames=()):
+        self._frames = frames
+    
+    @classmethod
+    def from_patterns(cls, base_dir, patterns):
+        rules = [rule for rule in (cls._parse_pattern(pattern) for pattern in patterns) if rule is not None]
+        return cls(((base_dir.__str__(), rules),) if rules else ())
+    
+    def extended_with_files(self, base_dir, ignore_files_paths):
+        patterns = []
+        for ignore_file_path in ignore_files_paths:
+            try:
+                patterns.extend(ignore_file_path.read_text(errors='replace').splitlines())
+            except OSError as e:
+                _logger.warning(f'Cannot read ignore file {ignore_file_path}: {e}')
+        
+        return self + _IgnoreRules.from_patterns(base_dir, patterns)
+    
+    def __add__(self, other):
+        return _IgnoreRules(self._frames + other._frames)
+    
+    def is_ignored(self, path, is_dir):
+        path = path.__str__()
+        is_ignored = False
+        for base_dir, rules in self._frames:
+            # Walked paths are always below the rules base directory so the prefix is just cut off
+            relative_path = path[base_dir.__len__():].lstrip(os.sep).replace(os.sep, '/')
+            for regex, is_negated, is_dir_only in rules:
+                if (is_dir or not is_dir_only) and regex.match(relative_path):
+                    is_ignored = not is_negated
+        
+        return is_ignored
+    
+    @classmethod
+    def _parse_pattern(cls, pattern):
+        pattern = pattern.rstrip()
+        if not pattern or pattern.startswith('#'):
+            return None
+        
+        is_negated = pattern.startswith('!')
+        if is_negated or pattern.startswith('\\'):
+            pattern = pattern[1:]
+        is_dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if not pattern:
+            return None
+        
+        # Pattern without a slash matches at any level, otherwise it is relative to the base directory
+        is_anchored = '/' in pattern
+        regex = cls._translate_glob(pattern.lstrip('/'))
+        regex = f'^{regex}$' if is_anchored else f'^(?:.*/)?{regex}$'
+        
+        return re.compile(regex), is_negated, is_dir_only
+    
+    @staticmethod
+    def _translate_glob(pattern):
+        regex = ''
+        i = 0
+        while i < pattern.__len__():
+            if pattern.startswith('**/', i):
+                regex += '(?:.*/)?'
+                i += 3
+            elif pattern.startswith('**', i):
+                regex += '.*'
+                i += 2
+            elif pattern[i] == '*':
+                regex += '[^/]*'
+                i += 1
+            elif pattern[i] == '?':
+                regex += '[^/]'
+                i += 1
+            elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+                end = pattern.index(']', i + 2)
+                char_class = pattern[i + 1:end].replace('\\', '\\\\')
+                if char_class.startswith('!'):
+                    char_class = '^' + char_class[1:]
+                regex += f'[{char_class}]'
+                i = end + 1
+            else:
+                regex += re.escape(pattern[i])
+                i += 1
+        
+        return regex
+
+
+class _FormatCache():
+    # Keeps hashes of files whose formatted output is known to equal their content, oldest first
+    # Formatted output depends also on the local config files found next to a file
+    is_config_state_used = True
+    
+    def __init__(self, path, formatter, setup_path, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._formatter = formatter
+        self._setup_path = setup_path
+        self._fingerprint = self._get_fingerprint(formatter, setup_path)
+        self._keys = self._load()
+        self._files_keys = {}
+        self._is_modified = False
+    
+    def clear(self):
+        self._keys.clear()
+        self._is_modified = True
+    
+    def is_clean(self, file_path):
+        key = self._get_file_key(file_path)
+        if key not in self._keys:
+            return False
+        
+        self._keys[key] = self._keys.pop(key)
+        self._is_modified = True
+        return True
+    
+    def mark_clean(self, file_path):
+        self._keys[self._get_file_key(file_path)] = None
+        self._is_modified = True
+    
+    def save(self):
+        if not self._is_modified:
+            return
+        
+        keys = list(self._keys)[-self.max_entries:] if self.max_entries > 0 else []
+        temp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        temp_path.write_text(json.dumps({'fingerprint': self._fingerprint, 'keys': keys}))
+        os.replace(temp_path, self.path)
+        self._is_modified = False
+    
+    def _load(self):
+        try:
+            content = json.loads(self.path.read_text())
+        except OSError:
+            return {}
+        except ValueError:
+            _logger.warning(f'Format cache {self.path} is corrupted and will be rebuilt.')
+            return {}
+        
+        if content.get('fingerprint') != self._fingerprint:
+            return {}
+        
+        return dict.fromkeys(content.get('keys', []))
+    
+    def _get_file_key(self, file_path):
+        if file_path not in self._files_keys:
+            file_hash = hashlib.blake2b(file_path.read_bytes(), digest_size=16)
+            if self.is_config_state_used and hasattr(self._formatter, 'get_config_state'):
+                file_hash.update(repr(self._formatter.get_config_state(file_path, self._setup_path)).encode())
+            self._files_keys[file_path] = file_hash.hexdigest()
+        
+        return self._files_keys[file_path]
+    
+    @staticmethod
+    def _get_fingerprint(formatter, setup_path):
+        return f'{formatter.name}:{formatter.get_version()}:{_get_setup_hash(setup_path)}'
+
+
+class _LintCache(_FormatCache):
+    # Keeps hashes of files that were linted with no findings, the linter reads only the setup file
+    is_config_state_used = False
+    
+    @staticmethod
+    def _get_fingerprint(formatter, setup_path):
+        return f'{formatter.linter.name}:{formatter.get_linter_version()}:{_get_setup_hash(setup_path)}'
+
+
+def _get_setup_hash(setup_path):
+    return '' if setup_path is None else hashlib.blake2b(setup_path.read_bytes(), digest_size=16).hexdigest()
+
+
+def format_file(formatter, path, setup_path=None, with_meld=True, get_logger=None,
+                lint_backend=LintBackend.SUBPROCESS, check=False, diff=False, diff_file=None):
     if get_logger:
         global _logger
         _logger = get_logger(__name__)
-    formatter = _get_formatter(formatter)
-    _print_greeting(formatter, path, PathType.FILE, with_meld)
+    formatter = _get_formatter(formatter, lint_backend)
+    _print_greeting(formatter, path, PathType.FILE, with_meld, check or diff)
     
     path = _check_path(path, PathType.FILE)
     setup_path = _check_setup_file(setup_path)
     
-    formatted_file_path = formatter.format_file(path, setup_path)
+    if check:
+        return _check_files(formatter, (path,), setup_path, 1)
+    if diff:
+        diff_files, failed_files = _diff_files(formatter, (path,), setup_path, 1, _get_diff_base_path(path.parent),
+                                               diff_file)
+        if failed_files:
+            raise DiffError(f'Error occured when format {path}: {failed_files[path]}', _logger)
+        return diff_files[0] if diff_files else None
+    
+    # Only the server keeps the style file copies between files
+    with _get_style_dirs_scope(formatter):
+        final_formatted_file_path = _format_file(formatter, path, setup_path, with_meld)
+    
+    if hasattr(formatter, 'lint_file'):
+        linter_output = formatter.lint_file(path, setup_path)
+        if linter_output:
+            print(linter_output)
+            
+    return final_formatted_file_path
+
+
+def format_dir(formatter, path, setup_path=None, with_meld=True, get_logger=None, jobs=None,
+               use_cache=False, clear_cache=False, exclude=DEFAULT_EXCLUDES, use_ignore_files=True,
+               git_base=None, git_staged=False, git_untracked=False, git_changed_lines_only=False,
+               lint_backend=LintBackend.SUBPROCESS, check=False, fail_fast=False, diff=False, diff_file=None,
+               batch_meld=False, with_report=False, hooks=()):
+    start_time = time.perf_counter()
+    if get_logger:
+        global _logger
+        _logger = get_logger(__name__)
+    formatter = _get_formatter(formatter, lint_backend)
+    _print_greeting(formatter, path, PathType.DIRECTORY, with_meld, check or diff)
 
+    path = _check_path(path, PathType.DIRECTORY)
+    setup_path = _check_setup_file(setup_path)
+    
+    files_line_ranges = None
+    if git_changed_lines_only:
+        if git_base is None and not git_staged and not git_untracked:
+            raise GitError('Changed lines mode needs git_base, git_staged or git_untracked to be set!', _logger)
+        files_line_ranges = _get_git_changed_lines(path, git_base)
+    
+    if git_base is not None or git_staged or git_untracked:
+        files_to_format = _collect_changed_files_to_format(formatter, path, git_base, git_staged, git_untracked,
+                                                           exclude=exclude, use_ignore_files=use_ignore_files)
+    else:
+        files_to_format = _collect_files_to_format(formatter, path, exclude=exclude, use_ignore_files=use_ignore_files)
+    # Per-file records are built only when they are asked for, by the report or by the hooks
+    report = FormatReport(hooks) if with_report or hooks else None
+    files_to_lint = None
+    if report is not None:
+        files_to_format = _record_files(files_to_format, report)
+    elif hasattr(formatter, 'lint_files') and not check and not diff:
+        files_to_lint = []
+        files_to_format = _remember_files(files_to_format, files_to_lint)
+    
+    cache = None
+    if use_cache or clear_cache:
+        cache = _FormatCache(path / CACHE_FILE_NAME, formatter, setup_path)
+        if clear_cache:
+            cache.clear()
+    if use_cache:
+        files_to_format = _filter_cached_files(cache, files_to_format)
+    # Formatting only changed lines does not tell whether the whole file is formatted
+    is_cache_updated = use_cache and files_line_ranges is None
+    
+    if check:
+        result = _check_files(formatter, files_to_format, setup_path, jobs, files_line_ranges,
+                              cache if is_cache_updated else None, fail_fast)
+        if cache is not None:
+            cache.save()
+        return result
+    if diff:
+        diff_files, failed_files = _diff_files(formatter, files_to_format, setup_path, jobs,
+                                               _get_diff_base_path(path), diff_file, files_line_ranges,
+                                               cache if is_cache_updated else None, report)
+        if cache is not None:
+            cache.save()
+        if with_report:
+            report.finish(time.perf_counter() - start_time)
+            return report
+        # Diffs of the other files are written already, the error tells that the patch is not complete
+        if failed_files:
+            raise DiffError(f'Error occured when format {failed_files.__len__()} of the files, '
+                            f'the diff is not complete: {", ".join(map(str, failed_files))}', _logger)
+        return diff_files if diff_files else None
+    
+    final_formatted_files = []
+    with tempfile.TemporaryDirectory(prefix='meldformat_') as work_dir:
+        if with_meld:
+            _check_meld()
+            formatted_files = _iter_formatted_files(formatter, files_to_format, setup_path, jobs, Path(work_dir),
+                                                    files_line_ranges, report)
+            mirror_dir_path = Path(work_dir) / 'mirror'
+            files_to_merge = []
+            # Run may stop part-way, e.g. on a meld error, so the workers and files in flight are released at once
+            try:
+                for original_file_path, formatted_file_path in formatted_files:
+                    with _get_span(report, Phase.COMPARE, original_file_path):
+                        is_unchanged = _is_line_endings_differences_or_no_changes(original_file_path,
+                                                                                  formatted_file_path)
+                    if is_unchanged:
+                        _logger.info(f'No changes in {original_file_path}.')
+                        if is_cache_updated and filecmp.cmp(original_file_path, formatted_file_path, shallow=False):
+                            cache.mark_clean(original_file_path)
+                    elif batch_meld:
+                        # Changed files wait for the review in the mirror directory, only unchanged ones are removed
+                        files_to_merge.append((original_file_path, _mirror_formatted_file(original_file_path,
+                                                                                          formatted_file_path, path,
+                                                                                          mirror_dir_path)))
+                    else:
+                        with _get_span(report, Phase.MERGE, original_file_path):
+                            _merge_changes(original_file_path, formatted_file_path)
+                        final_formatted_files.append(original_file_path)
+            finally:
+                formatted_files.close()
+            if files_to_merge:
+                with _get_span(report, Phase.MERGE):
+                    final_formatted_files.extend(_merge_changes_in_batches(files_to_merge))
+        elif hasattr(formatter, 'format_code'):
+            changes = _map_files(_format_file_in_memory, formatter, files_to_format, setup_path, jobs,
+                                 files_line_ranges, report)
+            try:
+                for original_file_path, is_changed in changes:
+                    if is_changed:
+                        final_formatted_files.append(original_file_path)
+                    else:
+                        _logger.info(f'No changes in {original_file_path}.')
+                        if is_cache_updated:
+                            cache.mark_clean(original_file_path)
+            finally:
+                changes.close()
+        else:
+            formatted_files = _iter_formatted_files(formatter, files_to_format, setup_path, jobs, Path(work_dir),
+                                                    files_line_ranges, report)
+            try:
+                for original_file_path, formatted_file_path in formatted_files:
+                    with _get_span(report, Phase.COMPARE, original_file_path):
+                        is_unchanged = filecmp.cmp(original_file_path, formatted_file_path)
+                    if is_unchanged:
+                        _logger.info(f'No changes in {original_file_path}.')
+                        if is_cache_updated:
+                            cache.mark_clean(original_file_path)
+                    else:
+                        with _get_span(report, Phase.WRITE, original_file_path):
+                            _replace_with_formatted_file(original_file_path, formatted_file_path)
+                        final_formatted_files.append(original_file_path)
+            finally:
+                formatted_files.close()
+    
+    if report is not None:
+        for final_formatted_file_path in final_formatted_files:
+            report[final_formatted_file_path].status = FileStatus.CHANGED
+    
+    if cache is not None:
+        cache.save()
+    
+    if hasattr(formatter, 'lint_files'):
+        lint_cache = None
+        if use_cache or clear_cache:
+            lint_cache = _LintCache(path / LINT_CACHE_FILE_NAME, formatter, setup_path)
+            if clear_cache:
+                lint_cache.clear()
+        if report is not None:
+            files_to_lint = (result.path for result in report.files)
+        _lint_files(formatter, files_to_lint, setup_path, jobs, lint_cache if use_cache else None, report)
+        if lint_cache is not None:
+            lint_cache.save()
+    
+    if with_report:
+        report.finish(time.perf_counter() - start_time)
+        return report
+    
+    return final_formatted_files if final_formatted_files.__len__() > 0 else None
+
+
+def run_server(socket_path=None, get_logger=None):
+    if get_logger:
+        global _logger
+        _logger = get_logger(__name__)
+    
+    server = _create_server(socket_path)
+    socket_path = Path(server.server_address)
+    _logger.info(f'Serve formatting requests on {socket_path}.')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if socket_path.exists():
+            socket_path.unlink()
+
+
+def _format_file(formatter, path, setup_path, with_meld):
     if with_meld:
+        formatted_file_path = formatter.format_file(path, setup_path)
         if _is_line_endings_differences_or_no_changes(path, formatted_file_path):
             _logger.info(f'No changes in {path}.')
             final_formatted_file_path = None    
@@ -153,72 +1164,209 @@ def format_file(formatter, path, setup_path=None, with_meld=True, get_logger=Non
             _check_meld()
             _merge_changes(path, formatted_file_path)
             final_formatted_file_path = path
+        _remove_temp_file(formatted_file_path)
+    elif hasattr(formatter, 'format_code') or hasattr(formatter, 'format_content'):
+        # Content is formatted in memory and written back atomically, without a temp copy of the file
+        if _format_file_in_memory(formatter, path, setup_path):
+            final_formatted_file_path = path
+        else:
+            _logger.info(f'No changes in {path}.')
+            final_formatted_file_path = None
     else:
+        formatted_file_path = formatter.format_file(path, setup_path)
         if filecmp.cmp(path, formatted_file_path):
             _logger.info(f'No changes in {path}.')
             final_formatted_file_path = None    
         else:
-            path.unlink()
-            shutil.copy(formatted_file_path, path)
+            _replace_with_formatted_file(path, formatted_file_path)
             final_formatted_file_path = path
+        _remove_temp_file(formatted_file_path)
     
-    if hasattr(formatter, 'lint_file'):
-        linter_output = formatter.lint_file(path, setup_path)
-        if linter_output:
-            print(linter_output)
-            
     return final_formatted_file_path
 
 
-def format_dir(formatter, path, setup_path=None, with_meld=True, get_logger=None):
-    if get_logger:
-        global _logger
-        _logger = get_logger(__name__)
-    formatter = _get_formatter(formatter)
-    _print_greeting(formatter, path, PathType.DIRECTORY, with_meld)
-
-    path = _check_path(path, PathType.DIRECTORY)
-    setup_path = _check_setup_file(setup_path)
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='meldformat',
+                                     description='Format source files and merge the changes in Meld.')
+    parser.add_argument('paths', nargs='*', help='files and directories to format')
+    parser.add_argument('-f', '--formatter', default=Formatter.AUTOPEP8.name.lower(),
+                        choices=[formatter.name.lower() for formatter in Formatter], help='formatter to use')
+    parser.add_argument('-s', '--setup', help='formatter setup file')
+    parser.add_argument('-j', '--jobs', type=int, help='number of parallel jobs, by default the CPU count')
+    parser.add_argument('--check', action='store_true',
+                        help='do not write files, exit with code 1 when formatting would change them')
+    parser.add_argument('--diff', action='store_true', help='do not write files, print diffs of the changes')
+    parser.add_argument('--diff-file', help='write diffs of the changes to a patch file instead of printing them')
+    parser.add_argument('--fail-fast', action='store_true', help='stop checking at the first unformatted file')
+    parser.add_argument('--no-meld', action='store_true', help='write formatted files without merging in Meld')
+    parser.add_argument('--batch-meld', action='store_true',
+                        help='merge all changed files of a directory in a few Meld tabs at once')
+    parser.add_argument('--cache', action='store_true', help='skip files known to be formatted')
+    parser.add_argument('--report', help='write a JSON report of the formatted directories, NDJSON for .ndjson files')
+    parser.add_argument('--timings', nargs='?', type=int, const=10, metavar='N',
+                        help='print time spent in each phase and N slowest files of the formatted directories')
+    parser.add_argument('--profile', help='write cProfile statistics of the run to a file readable by pstats')
+    parser.add_argument('--lint-backend', choices=[lint_backend.name.lower() for lint_backend in LintBackend],
+                        help='linter to use, subprocess by default')
+    parser.add_argument('--serve', action='store_true',
+                        help='run the server for meldformat-client until interrupted, instead of formatting paths')
+    parser.add_argument('--socket', help='server socket path, by default in the runtime directory')
+    parser.add_argument('-q', '--quiet', action='store_true', help='log only warnings and errors')
+    args = parser.parse_args(args)
+    if args.serve and args.paths:
+        parser.error('--serve does not take paths')
+    if not args.serve and not args.paths:
+        parser.error('the following arguments are required: paths')
+    if args.socket and not args.serve:
+        parser.error('--socket is used only with --serve')
+    # Check and diff neither write nor lint files, so the options of a format run would be silently ignored
+    if args.check or args.diff or args.diff_file:
+        format_options = {'--report': args.report, '--timings': args.timings is not None, '--cache': args.cache,
+                          '--lint-backend': args.lint_backend, '--no-meld': args.no_meld,
+                          '--batch-meld': args.batch_meld}
+        unsupported_options = [option for option, value in format_options.items() if value]
+        if unsupported_options:
+            parser.error(f'{", ".join(unsupported_options)} cannot be used with --check, --diff or --diff-file')
+    lint_backend = LintBackend[(args.lint_backend or LintBackend.SUBPROCESS.name).upper()]
     
-    files_to_format = _collect_files_to_format(formatter, path)
-    formatted_files = [formatter.format_file(file, setup_path) for file in files_to_format]
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format='%(message)s')
+    if args.serve:
+        return _serve(args.socket)
+    formatter = Formatter[args.formatter.upper()]
+    timing_collector = TimingCollector() if args.timings is not None else None
+    report = FormatReport()
+    is_failed = False
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if args.diff or args.diff_file:
+            with _open_diff_file(args.diff_file) as diff_file:
+                diff_files, is_failed = _diff_paths(formatter, args.paths, args.setup, args.jobs, diff_file)
+            if is_failed:
+                return 2
+            return 1 if args.check and diff_files else 0
+        
+        if args.check:
+            return _check_paths(formatter, args.paths, args.setup, args.jobs, args.fail_fast)
+        
+        # An error of one path is reported and the other paths are still formatted
+        for path in args.paths:
+            try:
+                if _get_path(path).is_dir():
+                    report.update(format_dir(formatter, path, args.setup, with_meld=not args.no_meld, jobs=args.jobs,
+                                             use_cache=args.cache, lint_backend=lint_backend,
+                                             batch_meld=args.batch_meld, with_report=True,
+                                             hooks=() if timing_collector is None else (timing_collector,)))
+                else:
+                    format_file(formatter, path, args.setup, with_meld=not args.no_meld, lint_backend=lint_backend)
+            except MeldFormatError as e:
+                _logger.error(e)
+                is_failed = True
+    except MeldFormatError as e:
+        _logger.error(e)
+        return 2
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(_get_path(args.profile).__str__())
+        if args.report:
+            _write_report(report, args.report)
     
-    final_formatted_files = []
-    if with_meld:
-        _check_meld()
-        for original_file_path, formatted_file_path in zip(files_to_format, formatted_files):
-            if _is_line_endings_differences_or_no_changes(original_file_path, formatted_file_path):
-                _logger.info(f'No changes in {original_file_path}.')
-            else:
-                _merge_changes(original_file_path, formatted_file_path)
-                final_formatted_files.append(original_file_path)
-    else:
-        for original_file_path, formatted_file_path in zip(files_to_format, formatted_files):
-            if filecmp.cmp(original_file_path, formatted_file_path):
-                _logger.info(f'No changes in {original_file_path}.')
+    if timing_collector is not None:
+        timing_collector.print_summary(args.timings)
+    
+    return 2 if is_failed or report.get_totals()[FileStatus.FAILED.value] else 0
+
+
+def _serve(socket_path):
+    # Termination stops the server the same way as an interrupt so the socket file is removed
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))
+    try:
+        run_server(socket_path)
+    except KeyboardInterrupt:
+        pass
+    except MeldFormatError as e:
+        _logger.error(e)
+        return 2
+    
+    return 0
+
+
+def _write_report(report, path):
+    path = _get_path(path)
+    with path.open('w', encoding='utf-8') as file:
+        file.write(report.to_ndjson() if path.suffix == '.ndjson' else report.to_json(indent=4))
+
+
+def _check_paths(formatter, paths, setup_path, jobs, fail_fast):
+    results = []
+    for path in paths:
+        try:
+            if _get_path(path).is_dir():
+                results.append(format_dir(formatter, path, setup_path, jobs=jobs, check=True, fail_fast=fail_fast))
             else:
-                original_file_path.unlink()
-                shutil.copy(formatted_file_path, original_file_path)
-                final_formatted_files.append(original_file_path)
+                results.append(format_file(formatter, path, setup_path, check=True))
+        except MeldFormatError as e:
+            # The path is reported as failed and the other paths are still checked
+            _logger.error(e)
+            results.append(CheckResult())
+            results[-1].failed_files[_get_path(path)] = e.__str__()
+        if fail_fast and not results[-1].is_formatted:
+            break
     
-    if hasattr(formatter, 'lint_file'):
-        for file in files_to_format:
-            linter_output = formatter.lint_file(file, setup_path)
-            if linter_output:
-                print(linter_output)
+    for result in results:
+        for file_path in result.unformatted_files:
+            _logger.warning(f'Would format {file_path}')
+    if any(result.failed_files for result in results):
+        return 2
     
-    return final_formatted_files if final_formatted_files.__len__() > 0 else None
+    return 0 if all(result.is_formatted for result in results) else 1
+
+
+def _diff_paths(formatter, paths, setup_path, jobs, diff_file):
+    # Diffs of the other files are still written when some files fail
+    diff_files = []
+    is_failed = False
+    for path in paths:
+        try:
+            if _get_path(path).is_dir():
+                report = format_dir(formatter, path, setup_path, jobs=jobs, diff=True, diff_file=diff_file,
+                                    with_report=True)
+                diff_files.extend(report.changed_files)
+                is_failed = is_failed or report.get_totals()[FileStatus.FAILED.value] > 0
+            else:
+                changed_file_path = format_file(formatter, path, setup_path, diff=True, diff_file=diff_file)
+                if changed_file_path is not None:
+                    diff_files.append(changed_file_path)
+        except DiffError:
+            # The error is logged already when the file is diffed
+            is_failed = True
+        except MeldFormatError as e:
+            _logger.error(e)
+            is_failed = True
+    
+    return diff_files, is_failed
 
 
-def _get_formatter(formatter):
+def _get_formatter(formatter, lint_backend=LintBackend.SUBPROCESS):
     if not isinstance(formatter, Formatter):
         raise FormatterNotSpecifiedError('Formatter is not specified properly. Use Formatter class', _logger)
+    if not isinstance(lint_backend, LintBackend):
+        raise LintBackendNotSpecifiedError('Lint backend is not specified properly. Use LintBackend class', _logger)
 
-    return formatter.value()
+    formatter = formatter.value()
+    if hasattr(formatter, 'lint_backend'):
+        formatter.lint_backend = lint_backend
+    
+    return formatter
 
 
-def _print_greeting(formatter, path, path_type, with_meld):
-    if with_meld:
+def _print_greeting(formatter, path, path_type, with_meld, check=False):
+    if check:
+        _logger.info(f'Check formatting of the {path_type.value}: {path} using the {formatter.name}.')
+    elif with_meld:
         _logger.info(f'Format the {path_type.value}: {path} using the {formatter.name} '
                      f'with merge mode in Meld.')
     else:
@@ -258,9 +1406,574 @@ def _check_setup_file(path):
     return setup_path
 
 
-def _collect_files_to_format(formatter, path):
-    return list(filter(None, list(chain.from_iterable(sorted(path.rglob(f'*{extension}')) 
-                                                      for extension in formatter.sources_extensions))))
+def _collect_files_to_format(formatter, path, ordered=False, exclude=DEFAULT_EXCLUDES, use_ignore_files=True):
+    extensions = tuple(formatter.sources_extensions)
+    ignore_rules = _get_base_ignore_rules(path, exclude, use_ignore_files)
+    
+    files = _walk_files(path, extensions, ignore_rules, use_ignore_files)
+    if ordered:
+        # The order of files grouped by extensions and sorted within a group
+        return sorted(files, key=lambda file: (next(i for i, extension in enumerate(extensions)
+                                                    if file.name.endswith(extension)), file))
+    
+    return files
+
+
+def _walk_files(path, extensions, ignore_rules, use_ignore_files):
+    # An unreadable directory is skipped so it does not stop the discovery of the others
+    try:
+        with os.scandir(path) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+    except OSError as e:
+        _logger.warning(f'Directory {path} skipped: {e}')
+        return
+    
+    if use_ignore_files:
+        ignore_files_paths = [Path(entry.path) for entry in entries
+                              if entry.name in IGNORE_FILES_NAMES and entry.is_file()]
+        if ignore_files_paths:
+            ignore_rules = ignore_rules.extended_with_files(path, ignore_files_paths)
+    
+    for entry in entries:
+        is_dir = entry.is_dir(follow_symlinks=False)
+        if not is_dir and not entry.name.endswith(extensions):
+            continue
+        # Ignored directory is pruned as a whole so the walk never descends into it
+        if ignore_rules.is_ignored(entry.path, is_dir):
+            continue
+        
+        if is_dir:
+            yield from _walk_files(Path(entry.path), extensions, ignore_rules, use_ignore_files)
+        elif entry.is_file():
+            yield Path(entry.path)
+
+
+def _collect_changed_files_to_format(formatter, path, git_base, git_staged, git_untracked,
+                                     exclude=DEFAULT_EXCLUDES, use_ignore_files=True):
+    extensions = tuple(formatter.sources_extensions)
+    changed_files = _get_git_changed_files(path, git_base, git_staged, git_untracked)
+    dirs_ignore_rules = {}
+    
+    def get_ignore_rules(directory):
+        # None marks a directory that is ignored itself or lies in an ignored directory
+        if directory not in dirs_ignore_rules:
+            if directory == path:
+                ignore_rules = _get_base_ignore_rules(path, exclude, use_ignore_files)
+            else:
+                ignore_rules = get_ignore_rules(directory.parent)
+                if ignore_rules is not None and ignore_rules.is_ignored(directory, True):
+                    ignore_rules = None
+            if ignore_rules is not None and use_ignore_files:
+                ignore_rules = ignore_rules.extended_with_files(directory, [directory / name
+                                                                            for name in IGNORE_FILES_NAMES
+                                                                            if (directory / name).is_file()])
+            dirs_ignore_rules[directory] = ignore_rules
+        
+        return dirs_ignore_rules[directory]
+    
+    for file in changed_files:
+        if not file.name.endswith(extensions) or path not in file.parents or not file.is_file():
+            continue
+        ignore_rules = get_ignore_rules(file.parent)
+        if ignore_rules is not None and not ignore_rules.is_ignored(file, False):
+            yield file
+
+
+def _get_git_changed_files(path, git_base, git_staged, git_untracked):
+    repo_path = _get_git_repo_path(path)
+    changed_files_names = set()
+    if git_base is not None:
+        changed_files_names.update(_execute_git_cmd(('diff', '--name-only', '-z', '--diff-filter=d',
+                                                     _get_git_merge_base(path, git_base)),
+                                                    path).split('\0'))
+    if git_staged:
+        changed_files_names.update(_execute_git_cmd(('diff', '--name-only', '-z', '--diff-filter=d', '--cached'),
+                                                    path).split('\0'))
+    if git_untracked:
+        changed_files_names.update(_execute_git_cmd(('ls-files', '--others', '--exclude-standard', '--full-name',
+                                                     '-z'), path).split('\0'))
+    
+    return sorted(repo_path / name for name in changed_files_names if name)
+
+
+def _get_git_changed_lines(path, git_base):
+    # Working tree is compared with HEAD when no base is given so both staged and not staged changes are taken
+    repo_path = _get_git_repo_path(path)
+    base = 'HEAD' if git_base is None else _get_git_merge_base(path, git_base)
+    diff = _execute_git_cmd(('-c', 'core.quotePath=false', 'diff', '-U0', '--no-color', '--no-ext-diff',
+                             '--diff-filter=d', '--src-prefix=a/', '--dst-prefix=b/', base, '--', '.'), path)
+    
+    files_line_ranges = {}
+    line_ranges = None
+    for line in diff.splitlines():
+        if line.startswith('+++ '):
+            line_ranges = files_line_ranges.setdefault(repo_path / line[len('+++ b/'):], [])
+        elif line.startswith('@@ ') and line_ranges is not None:
+            match = re.match(r'@@ -\S+ \+(\d+)(?:,(\d+))? @@', line)
+            start, count = int(match.group(1)), int(match.group(2) or 1)
+            # Hunk without new lines is a pure deletion so there is nothing to format
+            if count > 0:
+                line_ranges.append((start, start + count - 1))
+    
+    return files_line_ranges
+
+
+def _get_git_repo_path(path):
+    return Path(_execute_git_cmd(('rev-parse', '--show-toplevel'), path).strip()).resolve()
+
+
+def _get_git_merge_base(path, git_base):
+    # Changes are taken since the branch point so the base branch own progress is not included
+    return _execute_git_cmd(('merge-base', git_base, 'HEAD'), path).strip()
+
+
+def _get_base_ignore_rules(path, exclude, use_ignore_files):
+    ignore_rules = _IgnoreRules()
+    if use_ignore_files:
+        for directory in _get_repo_dirs_above(path):
+            ignore_rules = ignore_rules.extended_with_files(directory, [directory / name for name in IGNORE_FILES_NAMES
+                                                                        if (directory / name).is_file()])
+    
+    return ignore_rules + _IgnoreRules.from_patterns(path, exclude)
+
+
+def _get_repo_dirs_above(path):
+    # Ignore files from parent directories apply only up to the root of the repository the path belongs to
+    parents = list(path.parents)
+    for i, parent in enumerate(parents):
+        if (parent / '.git').exists():
+            return list(reversed(parents[:i + 1]))
+    
+    return []
+
+
+def _filter_cached_files(cache, files_to_format):
+    for file in files_to_format:
+        if cache.is_clean(file):
+            _logger.debug(f'No changes in {file} according to the format cache.')
+        else:
+            yield file
+
+
+def _remember_files(files, remembered_files):
+    for file in files:
+        remembered_files.append(file)
+        yield file
+
+
+def _get_span(report, phase, file_path=None):
+    return contextlib.nullcontext() if report is None else report.span(phase, file_path)
+
+
+def _record_files(files, report):
+    # Discovery is lazy so only the time spent to find the next file is measured
+    files = iter(files)
+    while True:
+        with report.span(Phase.DISCOVER):
+            file = next(files, None)
+        if file is None:
+            return
+        report.add_file(file)
+        yield file
+
+
+def _lint_files(formatter, files_to_lint, setup_path, jobs, lint_cache, report=None):
+    # Files are linted in batches so only the findings of one batch are kept at once
+    files_to_lint = iter(files_to_lint)
+    for files in iter(lambda: list(islice(files_to_lint, MAX_LINT_BATCH_SIZE)), []):
+        _lint_batch(formatter, files, setup_path, jobs, lint_cache, report)
+
+
+def _lint_batch(formatter, files_to_lint, setup_path, jobs, lint_cache, report):
+    if lint_cache is None:
+        files_not_cached = files_to_lint
+    else:
+        files_not_cached = [file for file in files_to_lint if not lint_cache.is_clean(file)]
+    start_time = time.perf_counter()
+    reports = formatter.lint_files(files_not_cached, setup_path, _get_jobs(jobs)) if files_not_cached else {}
+    # Files are linted in batches so each file gets an equal part of the time
+    lint_time = (time.perf_counter() - start_time) / max(1, files_not_cached.__len__())
+    
+    for file in files_to_lint:
+        if report is not None and file in reports:
+            report.record_lint(file, lint_time, reports[file])
+        _logger.info(f'Lint {file} file and show report.')
+        _logger.info(f'=============== {file.name} ===============')
+        if isinstance(reports.get(file), MeldFormatError):
+            _logger.error(f'Error occured when lint {file}: {reports[file]}')
+        elif reports.get(file):
+            print('\n'.join(reports[file]))
+        else:
+            _logger.info('File is OK!')
+            if lint_cache is not None and file in reports:
+                lint_cache.mark_clean(file)
+
+
+def _lint_file_in_process(formatter, file_to_lint_path, setup_path, line_ranges=None):
+    return formatter.lint_code(_read_source(file_to_lint_path)[0], file_to_lint_path, setup_path)
+
+
+def _get_jobs(jobs):
+    if jobs is None:
+        return os.cpu_count() or 1
+    
+    return max(1, jobs)
+
+
+def _iter_formatted_files(formatter, files_to_format, setup_path, jobs, work_dir, files_line_ranges=None,
+                          report=None):
+    # Formatted file is removed once the consumer asks for the next one, so it has to be merged, compared or moved
+    # before, and only the files in flight take the temp space whatever the number of files
+    for original_file_path, formatted_file_path in _iter_formatted_files_in_flight(formatter, files_to_format,
+                                                                                   setup_path, jobs, work_dir,
+                                                                                   files_line_ranges, report):
+        try:
+            yield original_file_path, formatted_file_path
+        finally:
+            _remove_temp_file(formatted_file_path, work_dir)
+
+
+def _iter_formatted_files_in_flight(formatter, files_to_format, setup_path, jobs, work_dir, files_line_ranges,
+                                    report):
+    jobs = _get_jobs(jobs)
+    if files_line_ranges is not None and hasattr(formatter, 'format_files_separately'):
+        def format_files_separately(files):
+            start_time = time.perf_counter()
+            results = formatter.format_files_separately(files, setup_path, jobs,
+                                                        [files_line_ranges.get(file) for file in files], work_dir)
+            format_time = (time.perf_counter() - start_time) / files.__len__()
+            return [(file, result, format_time) for file, result in zip(files, results)]
+        
+        # Line ranges differ between files so they cannot be passed to a single batch invocation
+        files_to_format = iter(files_to_format)
+        chunks = iter(lambda: list(islice(files_to_format, jobs * MAX_PENDING_FILES_PER_JOB)), [])
+        yield from _iter_format_results(chain.from_iterable(map(format_files_separately, chunks)), report)
+    elif not hasattr(formatter, 'format_files') or files_line_ranges is not None:
+        # Temp files are made in the work directory so the ones in flight are removed with it when the run stops
+        yield from _map_files(functools.partial(_format_file_to_temp, work_dir=work_dir), formatter, files_to_format,
+                              setup_path, jobs, files_line_ranges, report)
+    else:
+        def format_chunk(chunk_args):
+            chunk, chunk_work_dir = chunk_args
+            start_time = time.perf_counter()
+            results = formatter.format_files(chunk, setup_path, chunk_work_dir)
+            # Files of a chunk are formatted by a single process so each file gets an equal part of the time
+            format_time = (time.perf_counter() - start_time) / chunk.__len__()
+            return [(file, result, format_time) for file, result in zip(chunk, results)], chunk_work_dir
+        
+        def iter_chunks_results(chunks_results):
+            for chunk_results, chunk_work_dir in chunks_results:
+                yield from chunk_results
+                # Files of the chunk are consumed, the directory keeps only the copies of files that failed
+                shutil.rmtree(chunk_work_dir, ignore_errors=True)
+        
+        # Temp file path is the chunk directory, the file index directory and the file name with separators
+        temp_dir_length = (work_dir / f'chunk{sys.maxsize}' / f'{formatter.max_batch_size}').__str__().__len__() + 2
+        chunks = _split_into_chunks(files_to_format, formatter.max_batch_size, MAX_CMD_LENGTH,
+                                    lambda file: temp_dir_length + file.name.__len__())
+        # Each chunk is a single external process so threads are enough to keep them running in parallel
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            chunks_results = _iter_submitted(executor, lambda chunk_args: (format_chunk, chunk_args),
+                                             ((chunk, work_dir / f'chunk{i}') for i, chunk in enumerate(chunks)),
+                                             jobs * MAX_PENDING_FILES_PER_JOB)
+            yield from _iter_format_results(iter_chunks_results(chunks_results), report)
+
+
+def _iter_format_results(results, report):
+    for original_file_path, (formatted_file_path, error), format_time in results:
+        if report is not None:
+            report.record_format(original_file_path, format_time, error)
+        if error is None:
+            yield original_file_path, formatted_file_path
+        else:
+            _logger.error(f'Error occured when format {original_file_path}: {error}')
+
+
+def _remove_temp_file(temp_file_path, work_dir=None):
+    # Formatters put a temp file directly in the temp or work directory or in a private directory of its own
+    if temp_file_path.exists():
+        temp_file_path.unlink()
+    if temp_file_path.parent not in (Path(tempfile.gettempdir()), work_dir):
+        with contextlib.suppress(OSError):
+            temp_file_path.parent.rmdir()
+
+
+def _split_into_chunks(files, max_chunk_size, max_cmd_length, get_arg_length):
+    chunk = []
+    chunk_length = 0
+    for file in files:
+        file_length = get_arg_length(file)
+        if chunk and (chunk.__len__() >= max_chunk_size or chunk_length + file_length > max_cmd_length):
+            yield chunk
+            chunk = []
+            chunk_length = 0
+        chunk.append(file)
+        chunk_length += file_length
+    if chunk:
+        yield chunk
+
+
+def _map_files(function, formatter, files_to_format, setup_path, jobs, files_line_ranges=None, report=None):
+    for original_file_path, result, error, elapsed_time in _iter_mapped_files(function, formatter, files_to_format,
+                                                                              setup_path, jobs, files_line_ranges):
+        if report is not None:
+            report.record_format(original_file_path, elapsed_time, error)
+        if error is None:
+            yield original_file_path, result
+        else:
+            _logger.error(f'Error occured when format {original_file_path}: {error}')
+
+
+def _iter_mapped_files(function, formatter, files_to_format, setup_path, jobs, files_line_ranges=None):
+    files_to_format = iter(files_to_format)
+    jobs = _get_jobs(jobs)
+    # Files are streamed so the number of first files tells whether a bigger pool is worth to start
+    first_files = list(islice(files_to_format, jobs))
+    jobs = first_files.__len__()
+    # Only the ranges of a given file are sent to a worker instead of the whole mapping
+    files_args = ((file, None if files_line_ranges is None else files_line_ranges.get(file))
+                  for file in chain(first_files, files_to_format))
+    if jobs <= 1:
+        for file, line_ranges in files_args:
+            yield _call_safely(function, formatter, file, setup_path, line_ranges)
+        return
+    
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # Only a few files per worker are submitted ahead so a consumer that stops early does not wait for all
+        yield from _iter_submitted(executor, lambda file_args: (_call_safely, function, formatter, file_args[0],
+                                                                setup_path, file_args[1]),
+                                   files_args, jobs * MAX_PENDING_FILES_PER_JOB)
+
+
+def _iter_submitted(executor, get_call_args, items, max_pending):
+    # Results come in the items order and at most max_pending items are in flight, whatever the number of items
+    futures = collections.deque()
+    try:
+        for item in items:
+            futures.append(executor.submit(*get_call_args(item)))
+            if futures.__len__() >= max_pending:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def _call_safely(function, formatter, file_to_format_path, setup_path, line_ranges=None):
+    # Exceptions are returned as text because the repo exceptions carry a logger and cannot be pickled
+    start_time = time.perf_counter()
+    try:
+        result = function(formatter, file_to_format_path, setup_path, line_ranges)
+    except Exception as e:
+        return file_to_format_path, None, f'{e.__class__.__name__}: {e}', time.perf_counter() - start_time
+    
+    return file_to_format_path, result, None, time.perf_counter() - start_time
+
+
+def _format_file_to_temp(formatter, file_to_format_path, setup_path, line_ranges=None, work_dir=None):
+    if line_ranges is None:
+        return formatter.format_file(file_to_format_path, setup_path, work_dir=work_dir)
+    
+    return formatter.format_file(file_to_format_path, setup_path, line_ranges, work_dir)
+
+
+def _format_file_in_memory(formatter, file_to_format_path, setup_path, line_ranges=None):
+    source, formatted_source, encoding = _get_formatted_source(formatter, file_to_format_path, setup_path, line_ranges)
+    if formatted_source == source:
+        return False
+    
+    _write_source(file_to_format_path, formatted_source, encoding)
+    return True
+
+
+def _check_files(formatter, files_to_check, setup_path, jobs, files_line_ranges=None, cache=None, fail_fast=False):
+    result = CheckResult()
+    with _get_style_dirs_scope(formatter):
+        checked_files = _iter_mapped_files(_is_file_formatted, formatter, files_to_check, setup_path, jobs,
+                                           files_line_ranges)
+        try:
+            for file_path, is_formatted, error, _ in checked_files:
+                result.checked_files_count += 1
+                if error is not None:
+                    _logger.error(f'Error occured when check {file_path}: {error}')
+                    result.failed_files[file_path] = error
+                elif is_formatted:
+                    _logger.info(f'No changes in {file_path}.')
+                    if cache is not None:
+                        cache.mark_clean(file_path)
+                else:
+                    _logger.info(f'Formatting would change {file_path}.')
+                    result.unformatted_files.append(file_path)
+                
+                if fail_fast and not result.is_formatted:
+                    result.is_stopped_early = True
+                    break
+        finally:
+            checked_files.close()
+    
+    return result
+
+
+def _get_style_dirs_scope(formatter):
+    return formatter.style_dirs_scope() if hasattr(formatter, 'style_dirs_scope') else contextlib.nullcontext()
+
+
+def _is_file_formatted(formatter, file_to_format_path, setup_path, line_ranges=None):
+    source, formatted_source, _ = _get_formatted_source(formatter, file_to_format_path, setup_path, line_ranges)
+    return formatted_source == source
+
+
+def _get_formatted_source(formatter, file_to_format_path, setup_path, line_ranges=None):
+    source, encoding = _read_source(file_to_format_path)
+    if line_ranges is not None and not line_ranges:
+        formatted_source = source
+    elif hasattr(formatter, 'format_code'):
+        if line_ranges is None:
+            formatted_source = formatter.format_code(source, file_to_format_path, setup_path)
+        else:
+            formatted_source = formatter.format_code(source, file_to_format_path, setup_path, line_ranges)
+    else:
+        # Source is encoded back with the same encoding so the formatter gets the original bytes
+        formatted_source = formatter.format_content(source.encode(encoding), file_to_format_path.name, setup_path,
+                                                    line_ranges).decode(encoding)
+    
+    return source, formatted_source, encoding
+
+
+def _diff_files(formatter, files_to_diff, setup_path, jobs, base_path, diff_file, files_line_ranges=None,
+                cache=None, report=None):
+    diff_files = []
+    failed_files = {}
+    with _open_diff_file(diff_file) as output, _get_style_dirs_scope(formatter):
+        diffed_files = _iter_mapped_files(_get_diff_hunks, formatter, files_to_diff, setup_path, jobs,
+                                          files_line_ranges)
+        try:
+            for file_path, hunks, error, format_time in diffed_files:
+                if report is not None:
+                    report.record_format(file_path, format_time, error)
+                if error is not None:
+                    _logger.error(f'Error occured when format {file_path}: {error}')
+                    failed_files[file_path] = error
+                elif not hunks:
+                    _logger.info(f'No changes in {file_path}.')
+                    if cache is not None:
+                        cache.mark_clean(file_path)
+                else:
+                    output.write(_get_diff_header(file_path, base_path) + hunks)
+                    diff_files.append(file_path)
+                    if report is not None:
+                        report[file_path].status = FileStatus.CHANGED
+        finally:
+            diffed_files.close()
+    
+    return diff_files, failed_files
+
+
+@contextlib.contextmanager
+def _open_diff_file(diff_file):
+    if diff_file is None:
+        # Logs and other text written so far go first
+        sys.stdout.flush()
+        yield sys.stdout.buffer
+        sys.stdout.buffer.flush()
+    elif hasattr(diff_file, 'write'):
+        yield diff_file
+    else:
+        with open(diff_file, 'wb') as file:
+            yield file
+
+
+def _get_diff_base_path(path):
+    # Git applies patches with paths relative to the repository root
+    try:
+        return _get_git_repo_path(path)
+    except GitError:
+        return path
+
+
+def _get_diff_header(file_path, base_path):
+    try:
+        relative_path = file_path.relative_to(base_path).as_posix()
+    except ValueError:
+        relative_path = file_path.name
+    
+    return f'diff --git a/{relative_path} b/{relative_path}\n--- a/{relative_path}\n+++ b/{relative_path}\n'.encode()
+
+
+def _get_diff_hunks(formatter, file_to_format_path, setup_path, line_ranges=None):
+    source, formatted_source, encoding = _get_formatted_source(formatter, file_to_format_path, setup_path, line_ranges)
+    if formatted_source == source:
+        return b''
+    
+    hunks = []
+    # The first two lines are the file names header which is written with the paths relative to the base path
+    for line in islice(difflib.unified_diff(_split_lines(source), _split_lines(formatted_source)), 2, None):
+        hunks.append(line if line.endswith('\n') else f'{line}\n\\ No newline at end of file\n')
+    
+    # Hunks are encoded the same as the file so the patch applies to its bytes
+    return ''.join(hunks).encode(encoding)
+
+
+def _split_lines(source):
+    # Only the new line character ends a line for Git, a carriage return stays a part of the line
+    lines = [f'{line}\n' for line in source.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    return lines if lines[-1] else lines[:-1]
+
+
+def _read_source(path):
+    data = path.read_bytes()
+    try:
+        encoding = tokenize.detect_encoding(io.BytesIO(data).readline)[0]
+        return data.decode(encoding), encoding
+    except (LookupError, SyntaxError, UnicodeDecodeError):
+        return data.decode('latin-1'), 'latin-1'
+
+
+def _get_mtime(path):
+    if path is None:
+        return None
+    
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _write_source(path, source, encoding):
+    _write_file_atomically(path, source.encode(encoding))
+
+
+def _write_file_atomically(path, content):
+    # Content is written next to the file and renamed over it so the file is never missing or partly written,
+    # a symbolic link is followed so the file it points to is replaced instead of the link
+    path = path.resolve()
+    temp_fd, temp_path = tempfile.mkstemp(prefix=f'.{path.name}.', suffix='.tmp', dir=path.parent)
+    try:
+        with os.fdopen(temp_fd, 'wb') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if Path(temp_path).exists():
+            Path(temp_path).unlink()
+        raise
+
+
+def _replace_with_formatted_file(path, formatted_file_path):
+    path = path.resolve()
+    if formatted_file_path.stat().st_dev != path.stat().st_dev:
+        _write_file_atomically(path, formatted_file_path.read_bytes())
+        return
+    
+    # The formatted copy on the same file system is renamed over the file without copying its content
+    shutil.copymode(path, formatted_file_path)
+    with open(formatted_file_path, 'rb') as file:
+        os.fsync(file.fileno())
+    os.replace(formatted_file_path, path)
 
 
 def _check_meld():
@@ -269,40 +1982,259 @@ def _check_meld():
 
 
 def _is_line_endings_differences_or_no_changes(path1, path2):
-    with open(path1, 'r') as file1, open(path2, 'r') as file2:
-        file1_lines = [line.rstrip('\n') for line in file1]
-        file2_lines = [line.rstrip('\n') for line in file2] 
-    
-    if file1_lines.__len__() != file2_lines.__len__():
-        return False
+    if path1.stat().st_size == path2.stat().st_size and filecmp.cmp(path1, path2, shallow=False):
+        return True
     
-    for line1, line2 in zip(file1_lines, file2_lines):
-        if line1 != line2:
-            return False
+    with open(path1, 'rb') as file1, open(path2, 'rb') as file2:
+        chunks1 = _iter_chunks_with_normalized_line_endings(file1)
+        chunks2 = _iter_chunks_with_normalized_line_endings(file2)
+        buffer1 = buffer2 = b''
+        last_compared_byte = b''
+        while True:
+            buffer1 = buffer1 or next(chunks1, b'')
+            buffer2 = buffer2 or next(chunks2, b'')
+            if not buffer1 or not buffer2:
+                break
+            size = min(buffer1.__len__(), buffer2.__len__())
+            if buffer1[:size] != buffer2[:size]:
+                return False
+            last_compared_byte = buffer1[size - 1:size]
+            buffer1 = buffer1[size:]
+            buffer2 = buffer2[size:]
+        
+        # The only difference allowed at the end is a missing new line after the last line
+        rest, rest_chunks = (buffer1, chunks1) if buffer1 else (buffer2, chunks2)
+        if not rest:
+            return True
+        return rest == b'\n' and last_compared_byte not in (b'', b'\n') and next(rest_chunks, None) is None
 
-    return True
+
+def _iter_chunks_with_normalized_line_endings(file):
+    # Carriage return at the end of a chunk is kept back because it can be a part of CRLF split between chunks
+    pending = b''
+    while True:
+        chunk = file.read(COMPARE_CHUNK_SIZE)
+        if not chunk:
+            if pending:
+                yield b'\n'
+            return
+        
+        chunk = pending + chunk
+        pending = b'\r' if chunk.endswith(b'\r') else b''
+        chunk = chunk[:chunk.__len__() - pending.__len__()].replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        if chunk:
+            yield chunk
 
 
 def _merge_changes(file_to_format_path, formatted_file_path):
-    try:
-        _execute_cmd(('meld', 
-                      file_to_format_path.__str__(), 
-                      file_to_format_path.__str__(), 
-                      formatted_file_path.__str__(), 
-                      '-o', file_to_format_path.__str__()))
-    except ExecuteCmdError as e:
-        raise MeldError(f'Error occured while run Meld: {e}', _logger)
+    output, = _execute_cmds((('meld',
+                              file_to_format_path.__str__(),
+                              file_to_format_path.__str__(),
+                              formatted_file_path.__str__(),
+                              '-o', file_to_format_path.__str__()),), timeout=None)
+    if isinstance(output, ExecuteCmdError):
+        raise MeldError(f'Error occured while run Meld: {output}', _logger)
     formatted_file_path.unlink()
 
 
-def _execute_cmd(args):
+def _mirror_formatted_file(original_file_path, formatted_file_path, path, mirror_dir_path):
+    # Formatted files get the same relative paths in the mirror directory so Meld tabs show where they come from
+    mirrored_file_path = mirror_dir_path / original_file_path.relative_to(path)
+    mirrored_file_path.parent.mkdir(parents=True, exist_ok=True)
+    shutil.move(formatted_file_path.__str__(), mirrored_file_path.__str__())
+    
+    return mirrored_file_path
+
+
+def _merge_changes_in_batches(mirrored_files):
+    merged_files = []
+    for i in range(0, mirrored_files.__len__(), MELD_MAX_TABS):
+        batch = mirrored_files[i:i + MELD_MAX_TABS]
+        hashes = [hashlib.blake2b(original_file_path.read_bytes()).digest() for original_file_path, _ in batch]
+        # Each tab has the original file in the middle so saving it there writes the merged result
+        meld_args = chain.from_iterable(
+            ('--diff', original_file_path.__str__(), original_file_path.__str__(), mirrored_file_path.__str__())
+            for original_file_path, mirrored_file_path in batch)
+        output, = _execute_cmds((('meld', *meld_args),), timeout=None)
+        if isinstance(output, ExecuteCmdError):
+            raise MeldError(f'Error occured while run Meld: {output}', _logger)
+        
+        for (original_file_path, mirrored_file_path), file_hash in zip(batch, hashes):
+            mirrored_file_path.unlink()
+            if hashlib.blake2b(original_file_path.read_bytes()).digest() == file_hash:
+                _logger.info(f'No changes merged in {original_file_path}.')
+            else:
+                merged_files.append(original_file_path)
+    
+    return merged_files
+
+
+def _execute_cmd(args, timeout=CMD_TIMEOUT):
+    stdout, stderr = _run_cmd(args, timeout)
+    
+    return _decode_output(stdout, stderr)
+
+
+def _execute_cmds(cmds_args, jobs=1, timeout=CMD_TIMEOUT):
+    # Returns outputs in the commands order, a failed command gives the error instead of raising it
+    def execute_cmd(args):
+        try:
+            return _execute_cmd(args, timeout)
+        except ExecuteCmdError as e:
+            return e
+    
+    if jobs <= 1 or cmds_args.__len__() <= 1:
+        return [execute_cmd(args) for args in cmds_args]
+    
+    # Each command is an external process so threads are enough to run them at once, and unlike an event loop
+    # with subprocesses they work from any thread, e.g. from a server request handler
+    with ThreadPoolExecutor(max_workers=min(jobs, cmds_args.__len__())) as executor:
+        return list(executor.map(execute_cmd, cmds_args))
+
+
+def _run_cmd(args, timeout=CMD_TIMEOUT, input=None, cwd=None):
+    # The only place external tools are run, streams are captured apart so they do not interleave
     try:
         p = subprocess.run(args,
-                           check=True,
+                           input=input,
+                           cwd=None if cwd is None else cwd.__str__(),
                            stdout=subprocess.PIPE,
-                           stderr=subprocess.STDOUT,
-                           encoding='utf-8')
-    except subprocess.CalledProcessError as e:
-        raise ExecuteCmdError(e.output, _logger)
-    else:
-        return p.stdout
+                           stderr=subprocess.PIPE,
+                           timeout=timeout)
+    except OSError as e:
+        raise ExecuteCmdError(f'{args[0]} cannot be run: {e}', _logger)
+    except subprocess.TimeoutExpired:
+        raise ExecuteCmdError(f'{args[0]} has not finished in {timeout} seconds', _logger)
+    if p.returncode != 0:
+        raise ExecuteCmdError(_decode_output(p.stdout, p.stderr), _logger)
+    
+    return p.stdout, p.stderr
+
+
+def _decode_output(stdout, stderr):
+    # The output keeps stderr after stdout
+    return stdout.decode('utf-8', errors='replace') + stderr.decode('utf-8', errors='replace')
+
+
+class _ServerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            header, payload = meldformat_client.receive_message(self.rfile)
+        except (EOFError, ValueError) as e:
+            _logger.error(f'Incorrect request: {e}')
+            return
+        
+        try:
+            handler = self.server.commands[header['command']]
+            response, response_payload = handler(header, payload)
+            meldformat_client.send_message(self.wfile, {'error': None, **response}, response_payload)
+        except Exception as e:
+            meldformat_client.send_message(self.wfile, {'error': e.__str__() if isinstance(e, MeldFormatError) else
+                                                        f'{e.__class__.__name__}: {e}'})
+
+
+class _ServerFormatters():
+    # Formatters are kept between requests, their caches follow changes of the setup and config files themselves
+    def __init__(self):
+        self._formatters = {}
+        self._lock = threading.Lock()
+    
+    def get(self, header):
+        try:
+            formatter = Formatter[header['formatter']]
+            lint_backend = LintBackend[header['lint_backend']]
+        except KeyError as e:
+            raise FormatterNotSpecifiedError(f'Unknown formatter or lint backend: {e}', _logger)
+        setup_path = _check_setup_file(header['setup_path'])
+        
+        key = (formatter, lint_backend)
+        with self._lock:
+            if key not in self._formatters:
+                self._formatters[key] = _get_formatter(formatter, lint_backend)
+        
+        return self._formatters[key], setup_path
+
+
+def _create_server(socket_path):
+    if not hasattr(socket, 'AF_UNIX'):
+        raise ServerError('Unix sockets are not available on this platform', _logger)
+    
+    socket_path = meldformat_client.get_socket_path() if socket_path is None else Path(socket_path)
+    _prepare_socket_dir(socket_path.parent)
+    if socket_path.exists() or socket_path.is_symlink():
+        if _request_server(socket_path, {'command': 'ping'}) is not None:
+            raise ServerError(f'Server is already running on {socket_path}', _logger)
+        # Socket file is left by a server that did not stop cleanly
+        socket_path.unlink()
+    
+    # Socket is created with owner only permissions, changing them after bind would leave a window for others
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socket_path.__str__(), _ServerRequestHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    formatters = _ServerFormatters()
+    server.commands = {
+        'ping': lambda header, payload: ({}, b''),
+        'format_file': lambda header, payload: (_serve_format_file(formatters, header), b''),
+        'lint_file': lambda header, payload: (_serve_lint_file(formatters, header), b''),
+    }
+    
+    return server
+
+
+def _prepare_socket_dir(dir_path):
+    dir_path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    dir_stat = dir_path.lstat()
+    if dir_stat.st_uid != os.getuid() or not stat.S_ISDIR(dir_stat.st_mode):
+        raise ServerError(f'Socket directory {dir_path} is owned by another user', _logger)
+    if dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise ServerError(f'Socket directory {dir_path} is writable by other users', _logger)
+
+
+def _serve_format_file(formatters, header):
+    formatter, setup_path = formatters.get(header)
+    path = _check_path(header['path'], PathType.FILE)
+    final_formatted_file_path = _format_file(formatter, path, setup_path, header['with_meld'])
+    linter_output = None
+    if header['lint'] and hasattr(formatter, 'lint_file'):
+        linter_output = formatter.lint_file(path, setup_path)
+    
+    return {'formatted': final_formatted_file_path is not None, 'linter_output': linter_output}
+
+
+def _serve_lint_file(formatters, header):
+    formatter, setup_path = formatters.get(header)
+    path = _check_path(header['path'], PathType.FILE)
+    linter_output = formatter.lint_file(path, setup_path) if hasattr(formatter, 'lint_file') else None
+    
+    return {'linter_output': linter_output}
+
+
+def _request_server(socket_path, header, payload=b''):
+    # None means that the server is not running and the caller does the work itself
+    try:
+        return meldformat_client.request(header, payload, socket_path)
+    except meldformat_client.ServerNotRunningError:
+        return None
+    except meldformat_client.UntrustedSocketError as e:
+        raise ServerError(e.__str__(), _logger)
+    except (EOFError, ValueError) as e:
+        raise ServerError(f'Incorrect response from the server: {e}', _logger)
+
+
+def _execute_git_cmd(args, cwd):
+    # Stderr is kept apart because git warnings would mix with the parsed output
+    if shutil.which('git') is None:
+        raise GitError('Git not found. Please install it and add to PATH', _logger)
+    try:
+        stdout, _ = _run_cmd(('git', *args), cwd=cwd)
+    except ExecuteCmdError as e:
+        raise GitError(f'Error occured when run git {args[0]}: {e.__str__().strip()}', _logger)
+    
+    return stdout.decode('utf-8')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Thin client of the meldformat server, only the standard library is imported so it starts fast
+import os
+import sys
+import stat
+import json
+import struct
+import socket
+import tempfile
+import argparse
+from pathlib import Path
+
+
+SOCKET_FILE_NAME = 'meldformat.sock'
+TIMEOUT = 300
+MESSAGE_SIZES_FORMAT = '!II'
+
+
+class ServerNotRunningError(Exception):
+    pass
+
+
+class ServerError(Exception):
+    pass
+
+
+class UntrustedSocketError(ServerError):
+    pass
+
+
+def format_file(path, formatter='AUTOPEP8', setup_path=None, with_meld=False, lint=True,
+                lint_backend='SUBPROCESS', socket_path=None):
+    # Paths are absolute because the server runs in its own working directory
+    return _request_command({'command': 'format_file',
+                             'formatter': formatter,
+                             'path': Path(path).absolute().__str__(),
+                             'setup_path': None if setup_path is None else Path(setup_path).absolute().__str__(),
+                             'with_meld': with_meld,
+                             'lint': lint,
+                             'lint_backend': lint_backend}, socket_path)
+
+
+def lint_file(path, formatter='AUTOPEP8', setup_path=None, lint_backend='SUBPROCESS', socket_path=None):
+    return _request_command({'command': 'lint_file',
+                             'formatter': formatter,
+                             'path': Path(path).absolute().__str__(),
+                             'setup_path': None if setup_path is None else Path(setup_path).absolute().__str__(),
+                             'lint_backend': lint_backend}, socket_path)
+
+
+def request(header, payload=b'', socket_path=None):
+    if not hasattr(socket, 'AF_UNIX'):
+        raise ServerNotRunningError('Unix sockets are not available on this platform')
+
+    socket_path = get_socket_path() if socket_path is None else socket_path
+    check_socket(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(TIMEOUT)
+        try:
+            client.connect(Path(socket_path).__str__())
+        except OSError as e:
+            raise ServerNotRunningError(f'Server is not running on {socket_path}: {e}')
+        with client.makefile('rwb') as file:
+            send_message(file, header, payload)
+            return receive_message(file)
+
+
+def get_socket_path():
+    # Socket lives in a directory private to the user, the runtime directory or a 0700 directory made by the server,
+    # it is resolved on use and named by the uid which is known also to a user without a passwd entry
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return Path(os.environ['XDG_RUNTIME_DIR']) / SOCKET_FILE_NAME
+
+    return Path(tempfile.gettempdir()) / f'meldformat-{os.getuid()}' / SOCKET_FILE_NAME
+
+
+def check_socket(socket_path):
+    # Another user who owns the socket or can replace it would read the sources and send anything back as formatted
+    socket_path = Path(socket_path)
+    try:
+        dir_stat = socket_path.parent.lstat()
+        socket_stat = socket_path.lstat()
+    except OSError as e:
+        raise ServerNotRunningError(f'Server is not running on {socket_path}: {e}')
+
+    if dir_stat.st_uid != os.getuid() or socket_stat.st_uid != os.getuid():
+        raise UntrustedSocketError(f'Socket {socket_path} or its directory is owned by another user')
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise UntrustedSocketError(f'Socket directory {socket_path.parent} is writable by other users')
+    if not stat.S_ISSOCK(socket_stat.st_mode):
+        raise UntrustedSocketError(f'{socket_path} is not a socket')
+
+
+def send_message(file, header, payload=b''):
+    # Message is the header and the payload sizes followed by the JSON header and the raw payload
+    header = json.dumps(header).encode('utf-8')
+    file.write(struct.pack(MESSAGE_SIZES_FORMAT, header.__len__(), payload.__len__()) + header + payload)
+    file.flush()
+
+
+def receive_message(file):
+    header_size, payload_size = struct.unpack(MESSAGE_SIZES_FORMAT,
+                                              _read_exactly(file, struct.calcsize(MESSAGE_SIZES_FORMAT)))
+    header = json.loads(_read_exactly(file, header_size).decode('utf-8'))
+    return header, _read_exactly(file, payload_size)
+
+
+def _request_command(header, socket_path):
+    try:
+        response, _ = request(header, socket_path=socket_path)
+    except (EOFError, ValueError) as e:
+        raise ServerError(f'Incorrect response from the server: {e}')
+    if response['error'] is not None:
+        raise ServerError(response['error'])
+
+    return response
+
+
+def _read_exactly(file, size):
+    data = file.read(size)
+    if data.__len__() != size:
+        raise EOFError(f'Connection closed after {data.__len__()} of {size} bytes')
+
+    return data
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Format a file on the meldformat server.')
+    parser.add_argument('path', help='file to format')
+    parser.add_argument('--formatter', default='AUTOPEP8', type=str.upper, choices=('AUTOPEP8', 'CLANGFORMAT'))
+    parser.add_argument('--setup', help='formatter setup file')
+    parser.add_argument('--meld', action='store_true', help='merge changes in Meld')
+    parser.add_argument('--no-lint', action='store_true', help='skip linting')
+    parser.add_argument('--lint-backend', default='SUBPROCESS', type=str.upper, choices=('SUBPROCESS', 'IN_PROCESS'))
+    parser.add_argument('--socket', help='server socket path, by default in the runtime directory')
+    args = parser.parse_args(args)
+
+    try:
+        response = format_file(args.path, args.formatter, args.setup, args.meld, not args.no_lint,
+                               args.lint_backend, args.socket)
+    except ServerNotRunningError:
+        # Slow path, the same work is done in this process
+        import meldformat
+        meldformat.format_file(meldformat.Formatter[args.formatter], args.path, args.setup, args.meld,
+                               lint_backend=meldformat.LintBackend[args.lint_backend])
+        return 0
+    except ServerError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    if response['linter_output']:
+        print(response['linter_output'])
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,8 +2,10 @@
 # -*- coding: utf-8 -*-
 
 
+import os
 import stat
 import shutil
+import fnmatch
 from pathlib import Path
 
 from . import settings
@@ -34,7 +36,7 @@ def _clean_dirs(cwd, dirs_list=None):
         if directory['flag'] == '.':
             dirs_paths = sorted(Path(cwd).glob(directory['name']))
         elif directory['flag'] == 'r':
-            dirs_paths = sorted(Path(cwd).rglob(directory['name']))
+            dirs_paths = sorted(_find_dirs_recursively(cwd, directory['name']))
         else:
             raise exceptions.ValueError(f'Unknown remove flag {directory["flag"]}', _logger)
 
@@ -44,6 +46,18 @@ def _clean_dirs(cwd, dirs_list=None):
                 shutil.rmtree(dir_path, ignore_errors=False, onerror=_error_remove_readonly)
 
 
+def _find_dirs_recursively(cwd, pattern, dirs_to_skip=None):
+    dirs_to_skip = settings.DIRS_TO_SKIP_ON_CLEAN if dirs_to_skip is None else dirs_to_skip
+    for root, dirs, _ in os.walk(Path(cwd).resolve()):
+        for dir_name in list(dirs):
+            is_matched = fnmatch.fnmatch(dir_name, pattern)
+            if is_matched:
+                yield Path(root) / dir_name
+            # Matched directories are removed as a whole and skipped ones are not owned so both are not walked
+            if is_matched or any(fnmatch.fnmatch(dir_name, dir_to_skip) for dir_to_skip in dirs_to_skip):
+                dirs.remove(dir_name)
+
+
 def _error_remove_readonly(_action, name, _exc):
     Path(name).chmod(stat.S_IWRITE)
     Path(name).unlink()
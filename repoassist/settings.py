@@ -283,4 +283,16 @@ DIRS_TO_CLEAN = [
     {'name': 'htmlcov', 'flag': '.'},
 ]
 
+# Not descended into while looking for directories to clean recursively
+DIRS_TO_SKIP_ON_CLEAN = [
+    '.git',
+    '.hg',
+    '.svn',
+    '.tox',
+    '.nox',
+    '.venv',
+    'venv*',
+    'node_modules',
+]
+
 DEFAULT_REQUIREMENTS = ['setuptools']
@@ -2,16 +2,25 @@
 # -*- coding: utf-8 -*-
 
 
+import io
+import json
+import pickle
 import os
 import sys
 import stat
 import pytest
 import shutil
 import logging
+import subprocess
+import threading
 import tempfile
+import time
 from pathlib import Path
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 
 import meldformat
+import meldformat_client
 
 
 RUN_ALL_TESTS = True
@@ -358,6 +367,24 @@ def test_collect_files_to_format_SHOULD_collect_files_properly(cwd):
     assert paths == expected_paths
 
 
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_collect_files_to_format_SHOULD_keep_extensions_order_WHEN_ordered(cwd):
+    (cwd / 'b.c').touch()
+    (cwd / 'a.h').touch()
+    (cwd / 'dir').mkdir()
+    (cwd / 'dir' / 'a.c').touch()
+    (cwd / 'dir' / 'a.hpp').touch()
+    (cwd / 'dir.c').mkdir()
+    
+    formatter = meldformat.ClangFormatter
+    
+    streamed_paths = meldformat._collect_files_to_format(formatter, cwd)
+    ordered_paths = meldformat._collect_files_to_format(formatter, cwd, ordered=True)
+    
+    assert [path.relative_to(cwd).as_posix() for path in streamed_paths] == ['a.h', 'b.c', 'dir/a.c', 'dir/a.hpp']
+    assert [path.relative_to(cwd).as_posix() for path in ordered_paths] == ['b.c', 'dir/a.c', 'a.h', 'dir/a.hpp']
+
+
 @pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
 def test_format_dir_SHOULD_format_directory_properly(cwd):
     not_formatted_file1_content = """
@@ -447,3 +474,1048 @@ def test_format_dir_SHOULD_print_no_changes_WHEN_no_changes(cwd, caplog):
     assert test_file_path.read_text() == formatted_file_content
     assert formatted_files_paths is None
     assert 'No changes in' in caplog.text
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_format_directory_properly_WHEN_run_in_parallel(cwd):
+    not_formatted_file_content = """
+if __name__ == '__main__':
+    main()
+    
+"""
+
+    formatted_file_content = """
+if __name__ == '__main__':
+    main()
+"""
+    
+    files_paths = [cwd / f'module{i}.py' for i in range(8)]
+    for file_path in files_paths:
+        file_path.write_text(not_formatted_file_content)
+    
+    formatted_files_paths = meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False, jobs=4)
+    
+    assert formatted_files_paths == list(meldformat._collect_files_to_format(meldformat.Autopep8Formatter, cwd))
+    for file_path in files_paths:
+        assert file_path.read_text() == formatted_file_content
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_report_error_per_file_and_continue_WHEN_formatting_fails(cwd, caplog, monkeypatch):
+    not_formatted_file_content = """
+if __name__ == '__main__':
+    main()
+    
+"""
+    
+    format_code = meldformat.Autopep8Formatter.format_code
+    
+    def format_code_failing_on_broken(self, source, file_to_format_path, setup_path):
+        if file_to_format_path.name == 'broken.py':
+            raise RuntimeError('broken file')
+        return format_code(self, source, file_to_format_path, setup_path)
+    
+    monkeypatch.setattr(meldformat.Autopep8Formatter, 'format_code', format_code_failing_on_broken)
+    (cwd / 'broken.py').write_text(not_formatted_file_content)
+    (cwd / 'module.py').write_text(not_formatted_file_content)
+    
+    formatted_files_paths = meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False, jobs=1)
+    
+    assert formatted_files_paths == [cwd / 'module.py']
+    assert 'broken.py: RuntimeError: broken file' in caplog.text
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_file_SHOULD_keep_line_endings_and_leave_no_temp_files_WHEN_formatted_in_memory(cwd, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(cwd / 'tmp'))
+    (cwd / 'tmp').mkdir()
+    
+    test_file_path = cwd / 'module.py'
+    test_file_path.write_bytes(b"\r\nif __name__ == '__main__':\r\n    main()\r\n    \r\n")
+    
+    formatted_file_path = meldformat.format_file(meldformat.Formatter.AUTOPEP8, test_file_path, with_meld=False)
+    
+    assert test_file_path.read_bytes() == b"\r\nif __name__ == '__main__':\r\n    main()\r\n"
+    assert formatted_file_path == test_file_path
+    assert list((cwd / 'tmp').iterdir()) == []
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_skip_files_known_as_formatted_WHEN_cache_used(cwd, monkeypatch):
+    formatted_file_content = "\nif __name__ == '__main__':\n    main()\n"
+    
+    test_file_path = cwd / 'module.py'
+    with open(test_file_path, 'w', newline='\n')as file:
+        file.write(formatted_file_content)
+    
+    assert meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False, use_cache=True) is None
+    assert (cwd / meldformat.CACHE_FILE_NAME).exists()
+    
+    def format_code_not_expected(self, source, file_to_format_path, setup_path):
+        raise AssertionError(f'{file_to_format_path} should be skipped')
+    
+    monkeypatch.setattr(meldformat.Autopep8Formatter, 'format_code', format_code_not_expected)
+    
+    assert meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False, use_cache=True) is None
+    
+    monkeypatch.undo()
+    test_file_path.write_text(formatted_file_content + '    \n')
+    
+    assert meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False,
+                                 use_cache=True) == [test_file_path]
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_format_cached_file_again_WHEN_local_config_added(cwd):
+    setup_file_path = cwd / 'setup.cfg'
+    setup_file_path.write_text('[flake8]\nmax-line-length=119\n')
+    (cwd / 'pkg').mkdir()
+    test_file_path = cwd / 'pkg' / 'module.py'
+    test_file_path.write_text('values = [111111111, 222222222, 333333333, 444444444, 555555555, 666666666]\n')
+    
+    assert meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, setup_file_path, with_meld=False,
+                                 use_cache=True) is None
+    
+    (cwd / 'pkg' / 'tox.ini').write_text('[flake8]\nmax-line-length=60\n')
+    
+    assert meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, setup_file_path, with_meld=False,
+                                 use_cache=True) == [test_file_path]
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_cache_SHOULD_evict_oldest_entries_and_clear_all(cwd):
+    files_paths = [cwd / f'module{i}.py' for i in range(3)]
+    for i, file_path in enumerate(files_paths):
+        file_path.write_text(f'a = {i}\n')
+    
+    cache_path = cwd / meldformat.CACHE_FILE_NAME
+    cache = meldformat._FormatCache(cache_path, meldformat.Autopep8Formatter(), None, max_entries=2)
+    for file_path in files_paths:
+        cache.mark_clean(file_path)
+    cache.save()
+    
+    cache = meldformat._FormatCache(cache_path, meldformat.Autopep8Formatter(), None, max_entries=2)
+    assert [cache.is_clean(file_path) for file_path in files_paths] == [False, True, True]
+    
+    cache.clear()
+    cache.save()
+    
+    cache = meldformat._FormatCache(cache_path, meldformat.Autopep8Formatter(), None, max_entries=2)
+    assert [cache.is_clean(file_path) for file_path in files_paths] == [False, False, False]
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_autopep8_options_SHOULD_match_per_file_parsing_WHEN_cached(cwd):
+    setup_file_path = cwd / 'setup.cfg'
+    setup_file_path.write_text('[flake8]\naggressive=2\n')
+    (cwd / 'pkg' / 'sub').mkdir(parents=True)
+    (cwd / 'pkg' / 'tox.ini').write_text('[flake8]\nmax-line-length=100\n')
+    (cwd / 'other').mkdir()
+    (cwd / 'other' / 'pyproject.toml').write_text('[tool.autopep8]\nmax_line_length = 90\n')
+    
+    files_paths = [cwd / 'module.py',
+                   cwd / 'pkg' / 'module.py',
+                   cwd / 'pkg' / 'sub' / 'module.py',
+                   cwd / 'other' / 'module.py']
+    
+    formatter = meldformat.Autopep8Formatter()
+    for file_path in files_paths:
+        cached_options = vars(formatter._get_options(file_path, setup_file_path))
+        options = vars(formatter._get_options(file_path, setup_file_path, use_cache=False))
+        cached_options.pop('files')
+        options.pop('files')
+        
+        assert cached_options == options
+    
+    assert formatter._options_cache.__len__() == 3
+    
+    # Another formatter keeps its own caches and a worker copy finds its caches again for the next file
+    meldformat.Autopep8Formatter()
+    worker_formatter = pickle.loads(pickle.dumps(formatter))
+    worker_formatter._get_options(files_paths[0], setup_file_path)
+    
+    assert formatter._options_cache.__len__() == 3
+    assert pickle.loads(pickle.dumps(formatter))._options_cache.__len__() == 1
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_autopep8_options_SHOULD_follow_config_changes_WHEN_formatter_is_kept(cwd):
+    setup_file_path = cwd / 'setup.cfg'
+    setup_file_path.write_text('[flake8]\n')
+    (cwd / 'pkg').mkdir()
+    file_path = cwd / 'pkg' / 'module.py'
+    config_path = cwd / 'pkg' / 'tox.ini'
+    
+    formatter = meldformat.Autopep8Formatter()
+    
+    assert formatter._get_options(file_path, setup_file_path).max_line_length == 79
+    
+    config_path.write_text('[flake8]\nmax-line-length=100\n')
+    os.utime(config_path.parent, ns=(0, 10 ** 9))
+    
+    assert formatter._get_options(file_path, setup_file_path).max_line_length == 100
+    
+    config_path.write_text('[flake8]\nmax-line-length=110\n')
+    os.utime(config_path, ns=(0, 10 ** 9))
+    
+    assert formatter._get_options(file_path, setup_file_path).max_line_length == 110
+    
+    # Server threads share the formatter while new formatters are created
+    def get_options():
+        for _ in range(20):
+            meldformat.Autopep8Formatter()
+            assert formatter._get_options(file_path, setup_file_path).max_line_length == 110
+    
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda _: get_options(), range(4)))
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_clang_format_files_SHOULD_give_the_same_results_as_format_file(cwd):
+    not_formatted_file_content = """
+#include "module1.h"
+
+
+int module1_add(int a, int b) { return a + b; }
+"""
+    
+    (cwd / 'dir').mkdir()
+    files_paths = [cwd / 'module1.c', cwd / 'module2.cpp', cwd / 'dir' / 'module1.c']
+    for i, file_path in enumerate(files_paths):
+        file_path.write_text(not_formatted_file_content + f'int x{i} = {i};\n')
+    setup_path = Path(__file__).parent / '.clang-format'
+    
+    formatter = meldformat.ClangFormatter()
+    batch_results = formatter.format_files(files_paths, setup_path, cwd / 'work')
+    
+    for file_path, (formatted_file_path, error) in zip(files_paths, batch_results):
+        assert error is None
+        assert formatted_file_path.read_text() == formatter.format_file(file_path, setup_path).read_text()
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_split_into_chunks_SHOULD_respect_chunk_size_and_command_length(cwd):
+    files_paths = [cwd / f'module{i}.c' for i in range(10)]
+    
+    chunks = list(meldformat._split_into_chunks(iter(files_paths), 5, 100000, lambda file: file.__str__().__len__()))
+    
+    assert [chunk.__len__() for chunk in chunks] == [5, 5]
+    assert list(chain.from_iterable(chunks)) == files_paths
+    
+    chunks = list(meldformat._split_into_chunks(iter(files_paths), 10, 200, lambda file: file.__str__().__len__()))
+    
+    assert chunks.__len__() > 1
+    assert list(chain.from_iterable(chunks)) == files_paths
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_format_directory_properly_USING_clang_format(cwd):
+    not_formatted_file_content = """
+#include "module1.h"
+
+
+int module1_add(int a, int b) { return a + b; }
+"""
+
+    formatted_file_content = """
+#include "module1.h"
+
+int module1_add(int a, int b) { return a + b; }
+"""
+    
+    (cwd / 'dir').mkdir()
+    files_paths = [cwd / 'module1.c', cwd / 'module2.h', cwd / 'dir' / 'module3.cpp']
+    for file_path in files_paths:
+        file_path.write_text(not_formatted_file_content)
+    
+    formatted_files_paths = meldformat.format_dir(meldformat.Formatter.CLANGFORMAT, cwd, with_meld=False, jobs=2)
+    
+    assert set(formatted_files_paths) == set(files_paths)
+    for file_path in files_paths:
+        assert file_path.read_text() == formatted_file_content
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_clang_format_file_SHOULD_not_copy_setup_file_WHEN_style_file_path_supported(cwd, monkeypatch):
+    not_formatted_file_content = """
+#include "module1.h"
+
+int module1_add(int a, int b) { return a + b; }
+"""
+
+    formatted_file_content = """
+#include "module1.h"
+
+int module1_add(int a, int b)
+{
+  return a + b;
+}
+"""
+    
+    test_file_path = cwd / 'module.c'
+    test_file_path.write_text(not_formatted_file_content)
+    setup_path = Path(__file__).parent / '.clang-format'
+    formatter = meldformat.ClangFormatter()
+    
+    monkeypatch.setattr(meldformat.ClangFormatter, '_style_file_path_supported', True)
+    formatted_file_path = formatter.format_file(test_file_path, setup_path)
+    
+    assert formatted_file_path.read_text() == formatted_file_content
+    assert list(formatted_file_path.parent.iterdir()) == [formatted_file_path]
+    
+    monkeypatch.setattr(meldformat.ClangFormatter, '_style_file_path_supported', False)
+    formatted_file_path = formatter.format_file(test_file_path, setup_path)
+    
+    assert formatted_file_path.read_text() == formatted_file_content
+    assert list(formatted_file_path.parent.iterdir()) == [formatted_file_path]
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_clang_format_dir_SHOULD_remove_style_dirs_WHEN_check_or_diff_run_ends(cwd, monkeypatch):
+    (cwd / 'src').mkdir()
+    files_paths = [cwd / 'src' / f'module{i}.c' for i in range(4)]
+    for file_path in files_paths:
+        file_path.write_text('int add(int a, int b) { return a + b; }\n')
+    setup_path = Path(__file__).parent / '.clang-format'
+    temp_dir_path = cwd / 'tmp'
+    temp_dir_path.mkdir()
+    
+    monkeypatch.setattr(tempfile, 'tempdir', temp_dir_path.__str__())
+    monkeypatch.setattr(meldformat.ClangFormatter, '_style_file_path_supported', False)
+    monkeypatch.setattr(meldformat.ClangFormatter, '_style_dirs', {})
+    result = meldformat.format_dir(meldformat.Formatter.CLANGFORMAT, cwd / 'src', setup_path, jobs=2, check=True)
+    
+    assert sorted(result.unformatted_files) == files_paths
+    
+    diff_files = meldformat.format_dir(meldformat.Formatter.CLANGFORMAT, cwd / 'src', setup_path, jobs=1, diff=True,
+                                       diff_file=cwd / 'changes.diff')
+    
+    assert sorted(diff_files) == files_paths
+    assert list(temp_dir_path.iterdir()) == [] and not meldformat.ClangFormatter._style_dirs
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_collect_files_to_format_SHOULD_skip_excluded_and_ignored_paths(cwd):
+    for file_path in ['module.py', 'generated.py', 'keep_generated.py',
+                      'venv/lib/module.py', 'build/module.py', 'docs/conf.py',
+                      'pkg/module.py', 'pkg/local.py', 'pkg/sub/local.py', 'pkg/build/module.py']:
+        (cwd / file_path).parent.mkdir(parents=True, exist_ok=True)
+        (cwd / file_path).touch()
+    (cwd / '.gitignore').write_text('# Comment\n/build/\n*generated.py\n!keep_generated.py\n')
+    (cwd / 'pkg' / '.meldformatignore').write_text('/local.py\n')
+    
+    formatter = meldformat.Autopep8Formatter
+    
+    paths = [path.relative_to(cwd).as_posix()
+             for path in meldformat._collect_files_to_format(formatter, cwd, exclude=('docs/',))]
+    
+    assert paths == ['keep_generated.py', 'module.py', 'pkg/build/module.py', 'pkg/module.py', 'pkg/sub/local.py',
+                     'venv/lib/module.py']
+    
+    paths = [path.relative_to(cwd).as_posix()
+             for path in meldformat._collect_files_to_format(formatter, cwd / 'pkg', use_ignore_files=False)]
+    
+    assert paths == ['pkg/build/module.py', 'pkg/local.py', 'pkg/module.py', 'pkg/sub/local.py']
+    
+    paths = [path.relative_to(cwd).as_posix() for path in meldformat._collect_files_to_format(formatter, cwd)]
+    
+    assert 'venv/lib/module.py' not in paths
+    
+    (cwd / 'pkg' / 'sub' / 'old_generated.py').touch()
+    (cwd / '.git').mkdir()
+    
+    paths = [path.relative_to(cwd).as_posix() for path in meldformat._collect_files_to_format(formatter, cwd / 'pkg')]
+    
+    assert paths == ['pkg/build/module.py', 'pkg/module.py', 'pkg/sub/local.py']
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_collect_files_to_format_SHOULD_skip_directory_WHEN_it_cannot_be_read(cwd, monkeypatch):
+    for file_path in ['ok/a.py', 'locked/b.py']:
+        (cwd / file_path).parent.mkdir(parents=True, exist_ok=True)
+        (cwd / file_path).touch()
+    scandir = os.scandir
+    
+    def locked_scandir(path):
+        # Permissions are not checked for root so the unreadable directory is simulated
+        if Path(path).name == 'locked':
+            raise PermissionError(13, 'Permission denied', str(path))
+        return scandir(path)
+    
+    monkeypatch.setattr(os, 'scandir', locked_scandir)
+    paths = [path.relative_to(cwd).as_posix()
+             for path in meldformat._collect_files_to_format(meldformat.Autopep8Formatter, cwd)]
+    
+    assert paths == ['ok/a.py']
+
+
+def _git(cwd, *args):
+    return subprocess.run(('git', *args), cwd=cwd, check=True, stdout=subprocess.PIPE, encoding='utf-8').stdout
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_format_only_git_changed_files_WHEN_git_mode(cwd):
+    not_formatted_file_content = """
+if __name__ == '__main__':
+    main()
+    
+"""
+    
+    _git(cwd, 'init', '-q')
+    _git(cwd, 'config', 'user.email', 'tester@example.com')
+    _git(cwd, 'config', 'user.name', 'Tester')
+    for file_name in ['committed.py', 'changed.py', 'staged.py', 'changed.txt']:
+        (cwd / file_name).write_text(not_formatted_file_content)
+    _git(cwd, 'add', '.')
+    _git(cwd, 'commit', '-q', '-m', 'Initial commit')
+    _git(cwd, 'tag', 'base')
+    
+    (cwd / 'changed.py').write_text(not_formatted_file_content + 'a = 1\n')
+    (cwd / 'changed.txt').write_text(not_formatted_file_content + 'a = 1\n')
+    (cwd / 'staged.py').write_text(not_formatted_file_content + 'b = 1\n')
+    _git(cwd, 'add', 'staged.py')
+    (cwd / 'untracked.py').write_text(not_formatted_file_content)
+    (cwd / '.gitignore').write_text('ignored.py\n')
+    (cwd / 'ignored.py').write_text(not_formatted_file_content)
+    
+    def get_changed_files(**kwargs):
+        return [path.relative_to(cwd).as_posix()
+                for path in meldformat._collect_changed_files_to_format(meldformat.Autopep8Formatter, cwd, **kwargs)]
+    
+    assert get_changed_files(git_base='base', git_staged=False, git_untracked=False) == ['changed.py', 'staged.py']
+    assert get_changed_files(git_base=None, git_staged=True, git_untracked=False) == ['staged.py']
+    assert get_changed_files(git_base=None, git_staged=False, git_untracked=True) == ['untracked.py']
+    
+    formatted_files_paths = meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False,
+                                                  git_staged=True, git_untracked=True)
+    
+    assert formatted_files_paths == [cwd / 'staged.py', cwd / 'untracked.py']
+    assert (cwd / 'committed.py').read_text() == not_formatted_file_content
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_raise_error_WHEN_git_mode_outside_repository(cwd):
+    with pytest.raises(meldformat.GitError):
+        meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False, git_staged=True)
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_format_only_changed_lines_WHEN_git_changed_lines_only(cwd):
+    _git(cwd, 'init', '-q')
+    _git(cwd, 'config', 'user.email', 'tester@example.com')
+    _git(cwd, 'config', 'user.name', 'Tester')
+    (cwd / 'module.py').write_text('a=1\nb=2\nc=3\n')
+    (cwd / 'module.c').write_text('int a=1;\nint b=2;\nint c=3;\n')
+    _git(cwd, 'add', '.')
+    _git(cwd, 'commit', '-q', '-m', 'Initial commit')
+    
+    (cwd / 'module.py').write_text('a=1\nb=22\nc=3\n')
+    (cwd / 'module.c').write_text('int a=1;\nint b=22;\nint c=3;\n')
+    
+    for formatter in meldformat.Formatter:
+        meldformat.format_dir(formatter, cwd, with_meld=False, git_base='HEAD', git_changed_lines_only=True)
+    
+    assert (cwd / 'module.py').read_text() == 'a=1\nb = 22\nc=3\n'
+    assert (cwd / 'module.c').read_text() == 'int a=1;\nint b = 22;\nint c=3;\n'
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+@pytest.mark.parametrize('content1, content2, expected', [
+    (b'line1\r\nline2\r\n', b'line1\nline2\n', True),
+    (b'line1\rline2\r', b'line1\nline2\n', True),
+    (b'line1\nline2', b'line1\r\nline2\r\n', True),
+    (b'line1\nline2\n\n', b'line1\nline2\n', False),
+    (b'', b'\n', False),
+    (b'', b'', True),
+    (b'line1\r\r\nline2', b'line1\n\nline2', True),
+    (b'line1\r\nline2\r\n', b'line1\nline3\n', False),
+])
+def test_is_line_endings_differences_or_no_changes_SHOULD_compare_across_chunks(cwd, monkeypatch,
+                                                                                content1, content2, expected):
+    monkeypatch.setattr(meldformat, 'COMPARE_CHUNK_SIZE', 2)
+    file1_path = cwd / 'file1.txt'
+    file2_path = cwd / 'file2.txt'
+    file1_path.write_bytes(content1)
+    file2_path.write_bytes(content2)
+    
+    assert meldformat._is_line_endings_differences_or_no_changes(file1_path, file2_path) == expected
+    assert meldformat._is_line_endings_differences_or_no_changes(file2_path, file1_path) == expected
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_report_lint_findings_per_file_and_skip_clean_files_WHEN_cache_used(cwd, capsys,
+                                                                                              monkeypatch):
+    (cwd / 'clean.py').write_text('a = 1\n')
+    (cwd / 'dirty.py').write_text('import os\n')
+    
+    meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False, use_cache=True)
+    
+    output = capsys.readouterr().out
+    assert f'{cwd / "dirty.py"}:1:1: F401' in output
+    assert 'clean.py' not in output
+    
+    lint_files = meldformat.Autopep8Formatter.lint_files
+    linted_files = []
+    
+    def lint_files_recorded(self, files_to_lint_paths, setup_path, jobs):
+        linted_files.extend(files_to_lint_paths)
+        return lint_files(self, files_to_lint_paths, setup_path, jobs)
+    
+    monkeypatch.setattr(meldformat.Autopep8Formatter, 'lint_files', lint_files_recorded)
+    meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False, use_cache=True)
+    
+    assert linted_files == [cwd / 'dirty.py']
+    assert f'{cwd / "dirty.py"}:1:1: F401' in capsys.readouterr().out
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_report_the_same_as_flake8_WHEN_linted_in_process(cwd, capsys, monkeypatch):
+    setup_path = cwd / 'setup.cfg'
+    setup_path.write_text('[flake8]\nignore = D, H306\nmax-line-length=119\n')
+    (cwd / 'first.py').write_text('import os, sys\nx = 1  # noqa\n\n\ndef f(a):\n    y = 2\n    return a+1\n')
+    (cwd / 'second.py').write_text(f'l = "{"a" * 120}"\nz = "%s" % (1, 2)\n')
+    (cwd / 'broken.py').write_text('def f(:\n')
+    
+    meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, setup_path, with_meld=False,
+                          use_ignore_files=False, lint_backend=meldformat.LintBackend.SUBPROCESS)
+    subprocess_output = capsys.readouterr().out
+    meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, setup_path, with_meld=False,
+                          use_ignore_files=False, lint_backend=meldformat.LintBackend.IN_PROCESS)
+    in_process_output = capsys.readouterr().out
+    
+    assert 'F401' in in_process_output and 'E999' in in_process_output
+    # Syntax error column is computed differently by Flake8 depending on the Python version
+    assert [line for line in in_process_output.splitlines() if 'E999' not in line] == \
+        [line for line in subprocess_output.splitlines() if 'E999' not in line]
+    
+    with pytest.raises(meldformat.LintBackendNotSpecifiedError):
+        meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, lint_backend='in_process')
+    
+    # Formatting would fix continuation lines so they are linted as they are
+    indented_file_path = cwd / 'indented.py'
+    indented_file_path.write_text('x = dict(a=1,\n           b=2)\ny = dict(a=1,\n     b=2)\n')
+    formatter = meldformat.Autopep8Formatter()
+    subprocess_reports = formatter.lint_files([indented_file_path], setup_path, 1)
+    formatter.lint_backend = meldformat.LintBackend.IN_PROCESS
+    
+    assert formatter.lint_files([indented_file_path], setup_path, 1) == subprocess_reports
+    assert [line.split(': ')[1][:4] for line in subprocess_reports[indented_file_path]] == ['E127', 'E128']
+    
+    monkeypatch.setattr(meldformat, 'pyflakes', None)
+    
+    assert isinstance(formatter.lint_files([indented_file_path], setup_path, 1)[indented_file_path],
+                      meldformat.LintError)
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_execute_cmds_SHOULD_run_commands_at_once_and_keep_order_WHEN_jobs_given(cwd):
+    sleep_cmd = (sys.executable, '-c', 'import sys, time; time.sleep(1); print(sys.argv[1])')
+    
+    start_time = time.monotonic()
+    outputs = meldformat._execute_cmds([(*sleep_cmd, f'{i}') for i in range(4)], jobs=4)
+    
+    assert time.monotonic() - start_time < 3
+    assert [output.strip() for output in outputs] == ['0', '1', '2', '3']
+    
+    outputs = meldformat._execute_cmds([(sys.executable, '-c', 'import sys; sys.exit("failed")'),
+                                        (*sleep_cmd, 'timeout')], jobs=2, timeout=0.2)
+    
+    assert isinstance(outputs[0], meldformat.ExecuteCmdError) and 'failed' in str(outputs[0])
+    assert isinstance(outputs[1], meldformat.ExecuteCmdError) and 'has not finished' in str(outputs[1])
+    
+    # Server request handlers run commands from their own threads
+    thread_outputs = []
+    thread = threading.Thread(target=lambda: thread_outputs.extend(
+        meldformat._execute_cmds([(*sleep_cmd, f'{i}') for i in range(2)], jobs=2)))
+    thread.start()
+    thread.join()
+    
+    assert [output.strip() for output in thread_outputs] == ['0', '1']
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_server_SHOULD_format_clang_file_from_memory_WHEN_requested_by_client(cwd, monkeypatch):
+    not_formatted_file_content = """
+#include "module1.h"
+
+int module1_add(int a, int b) { return a + b; }
+"""
+
+    formatted_file_content = """
+#include "module1.h"
+
+int module1_add(int a, int b)
+{
+  return a + b;
+}
+"""
+    
+    test_file_path = cwd / 'src' / 'module.c'
+    test_file_path.parent.mkdir()
+    test_file_path.write_text(not_formatted_file_content)
+    setup_path = Path(__file__).parent / '.clang-format'
+    socket_path = cwd / 'meldformat.sock'
+    # Neither a temp copy nor a process per copy is made for the file
+    monkeypatch.setattr(meldformat.ClangFormatter, '_format_files_separately', None)
+    
+    server = meldformat._create_server(socket_path)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    try:
+        response = meldformat_client.format_file(test_file_path, 'CLANGFORMAT', setup_path, socket_path=socket_path)
+        
+        assert response['formatted'] and test_file_path.read_text() == formatted_file_content
+        assert list(test_file_path.parent.iterdir()) == [test_file_path]
+        
+        with pytest.raises(meldformat_client.ServerError):
+            meldformat_client.format_file(test_file_path, 'CLANGFORMAT', cwd / 'not_existing_setup',
+                                          socket_path=socket_path)
+    finally:
+        server.shutdown()
+        server.server_close()
+        server_thread.join()
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_main_SHOULD_run_server_until_terminated_WHEN_serve(cwd):
+    test_file_path = cwd / 'module.py'
+    test_file_path.write_text('x=1\n')
+    socket_path = cwd / 'run' / 'meldformat.sock'
+    
+    with pytest.raises(SystemExit):
+        meldformat.main(['--serve', str(test_file_path)])
+    with pytest.raises(SystemExit):
+        meldformat.main([str(test_file_path), '--socket', str(socket_path)])
+    
+    server_process = subprocess.Popen([sys.executable, Path(meldformat.__file__).__str__(), '--serve',
+                                       '--socket', socket_path.__str__()])
+    try:
+        for _ in range(100):
+            if socket_path.exists():
+                break
+            time.sleep(0.1)
+        response = meldformat_client.format_file(test_file_path, lint=False, socket_path=socket_path)
+        
+        assert response['formatted'] and test_file_path.read_text() == 'x = 1\n'
+    finally:
+        server_process.terminate()
+        
+        assert server_process.wait(10) == 0
+    assert not socket_path.exists()
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_client_SHOULD_refuse_socket_WHEN_socket_directory_is_not_private(cwd):
+    socket_path = cwd / 'private' / 'meldformat.sock'
+    
+    server = meldformat._create_server(socket_path)
+    try:
+        assert stat.S_IMODE(socket_path.parent.stat().st_mode) == 0o700
+        assert stat.S_IMODE(socket_path.stat().st_mode) == 0o600
+        
+        socket_path.parent.chmod(0o777)
+        
+        with pytest.raises(meldformat_client.UntrustedSocketError):
+            meldformat_client.request({'command': 'ping'}, socket_path=socket_path)
+        with pytest.raises(meldformat.ServerError):
+            meldformat._create_server(socket_path)
+    finally:
+        server.server_close()
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_client_SHOULD_resolve_socket_path_by_uid_WHEN_used_not_when_imported(cwd, monkeypatch):
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+    monkeypatch.setattr(tempfile, 'tempdir', cwd.__str__())
+    
+    assert meldformat_client.get_socket_path() == cwd / f'meldformat-{os.getuid()}' / 'meldformat.sock'
+    with pytest.raises(meldformat_client.ServerNotRunningError):
+        meldformat_client.request({'command': 'ping'})
+    
+    server = meldformat._create_server(None)
+    try:
+        assert Path(server.server_address) == meldformat_client.get_socket_path()
+    finally:
+        server.server_close()
+    
+    # A user without a passwd entry still imports the library
+    code = 'import getpass; getpass.getuser = lambda: 1 / 0; import meldformat'
+    subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).parents[1], check=True)
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_server_SHOULD_format_and_lint_file_WHEN_requested_by_client(cwd, monkeypatch):
+    test_file_path = cwd / 'module.py'
+    test_file_path.write_text('import os\nx=1\n')
+    socket_path = cwd / 'meldformat.sock'
+    
+    with pytest.raises(meldformat_client.ServerNotRunningError):
+        meldformat_client.format_file(test_file_path, socket_path=socket_path)
+    
+    server = meldformat._create_server(socket_path)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    try:
+        response = meldformat_client.format_file(test_file_path, lint_backend='IN_PROCESS', socket_path=socket_path)
+        
+        assert response['formatted']
+        assert test_file_path.read_text() == 'import os\nx = 1\n'
+        assert f'{test_file_path}:1:1: F401' in response['linter_output']
+        
+        response = meldformat_client.format_file(test_file_path, lint=False, socket_path=socket_path)
+        
+        assert not response['formatted'] and response['linter_output'] is None
+        
+        with pytest.raises(meldformat_client.ServerError) as exc:
+            meldformat_client.lint_file(cwd / 'not_existing.py', socket_path=socket_path)
+        
+        assert 'File to format' in str(exc.value)
+    finally:
+        server.shutdown()
+        server.server_close()
+        server_thread.join()
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_main_SHOULD_check_diff_and_format_files_WHEN_run_from_command_line(cwd, capsys):
+    (cwd / 'dir').mkdir()
+    files_paths = [cwd / 'module.py', cwd / 'dir' / 'module.py']
+    for file_path in files_paths:
+        file_path.write_text('x=1\n')
+    
+    assert meldformat.main([str(cwd / 'module.py'), str(cwd / 'dir'), '--check', '-j', '2']) == 1
+    assert meldformat.main([str(cwd), '--diff']) == 0
+    assert '-x=1\n+x = 1\n' in capsys.readouterr().out
+    assert all(file_path.read_text() == 'x=1\n' for file_path in files_paths)
+    
+    assert meldformat.main([str(cwd), '--no-meld', '--lint-backend', 'in_process']) == 0
+    assert all(file_path.read_text() == 'x = 1\n' for file_path in files_paths)
+    assert meldformat.main([str(cwd), '--check']) == 0
+    assert meldformat.main([str(cwd / 'not_existing.py'), '--check']) == 2
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_main_SHOULD_return_error_code_WHEN_some_files_failed_to_format_or_diff(cwd, capsys, monkeypatch):
+    files_paths = [cwd / 'broken.py', cwd / 'module.py']
+    for file_path in files_paths:
+        file_path.write_text('x=1\n')
+    format_code = meldformat.Autopep8Formatter.format_code
+    
+    def failing_format_code(self, source, file_to_format_path, *args):
+        if file_to_format_path.name == 'broken.py':
+            raise ValueError('Broken file')
+        return format_code(self, source, file_to_format_path, *args)
+    
+    monkeypatch.setattr(meldformat.Autopep8Formatter, 'format_code', failing_format_code)
+    monkeypatch.setattr(meldformat.Autopep8Formatter, 'lint_files', lambda self, files, setup_path, jobs: {})
+    
+    assert meldformat.main([str(cwd), '--diff', '-j', '1']) == 2
+    assert '+x = 1\n' in capsys.readouterr().out
+    assert meldformat.main([str(files_paths[0]), str(files_paths[1]), '--diff']) == 2
+    assert '+x = 1\n' in capsys.readouterr().out
+    
+    diff_file = io.BytesIO()
+    with pytest.raises(meldformat.DiffError):
+        meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, jobs=1, diff=True, diff_file=diff_file)
+    
+    assert b'+x = 1\n' in diff_file.getvalue()
+    
+    assert meldformat.main([str(cwd), '--no-meld', '-j', '1']) == 2
+    assert [file_path.read_text() for file_path in files_paths] == ['x=1\n', 'x = 1\n']
+    assert meldformat.main([str(files_paths[1]), '--diff']) == 0
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_main_SHOULD_process_other_paths_and_write_report_WHEN_a_path_fails(cwd, capsys, monkeypatch):
+    (cwd / 'src').mkdir()
+    file_path = cwd / 'src' / 'module.py'
+    file_path.write_text('x=1\n')
+    report_path = cwd / 'report.json'
+    monkeypatch.setattr(meldformat.Autopep8Formatter, 'lint_files', lambda self, files, setup_path, jobs: {})
+    
+    for option in ('--report=report.json', '--timings', '--cache', '--lint-backend=in_process', '--no-meld'):
+        with pytest.raises(SystemExit):
+            meldformat.main([str(cwd / 'src'), '--check', option])
+        with pytest.raises(SystemExit):
+            meldformat.main([str(cwd / 'src'), '--diff', option])
+    
+    assert meldformat.main([str(cwd / 'not_existing'), str(cwd / 'src'), '--check']) == 2
+    assert meldformat.main([str(cwd / 'not_existing'), str(cwd / 'src'), '--diff']) == 2
+    assert '+x = 1\n' in capsys.readouterr().out
+    
+    assert meldformat.main([str(cwd / 'not_existing'), str(cwd / 'src'), '--no-meld',
+                            '--report', str(report_path)]) == 2
+    assert file_path.read_text() == 'x = 1\n'
+    assert json.loads(report_path.read_text())['totals']['changed'] == 1
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_report_unformatted_files_without_writing_WHEN_check(cwd, monkeypatch):
+    files_paths = [cwd / f'module{i}.py' for i in range(6)]
+    for i, file_path in enumerate(files_paths):
+        file_path.write_text('x=1\n' if i % 2 else 'x = 1\n')
+    
+    def no_temp_files(*args, **kwargs):
+        raise AssertionError('Temp file created')
+    
+    monkeypatch.setattr(tempfile, 'mkstemp', no_temp_files)
+    monkeypatch.setattr(tempfile, 'mkdtemp', no_temp_files)
+    result = meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, jobs=2, check=True)
+    
+    assert sorted(result.unformatted_files) == files_paths[1::2]
+    assert result.checked_files_count == 6 and not result.failed_files and not result.is_formatted
+    assert all(file_path.read_text() == ('x=1\n' if i % 2 else 'x = 1\n') for i, file_path in enumerate(files_paths))
+    
+    result = meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, jobs=1, check=True, fail_fast=True)
+    
+    assert result.unformatted_files.__len__() == 1 and result.checked_files_count < 6 and result.is_stopped_early
+    assert meldformat.format_file(meldformat.Formatter.AUTOPEP8, files_paths[0], check=True).is_formatted
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_write_patch_applicable_by_git_WHEN_diff(cwd):
+    (cwd / 'dir').mkdir()
+    sources = {cwd / 'module.py': 'x=1', cwd / 'dir' / 'module.py': 'import os\r\ny=[1,2]\r\n',
+               cwd / 'formatted.py': 'z = 1\n'}
+    for file_path, source in sources.items():
+        file_path.write_bytes(source.encode())
+    patch_path = cwd / 'changes.patch'
+    
+    diff_files = meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, diff=True, diff_file=patch_path)
+    
+    assert sorted(diff_files) == [cwd / 'dir' / 'module.py', cwd / 'module.py']
+    assert all(file_path.read_bytes() == source.encode() for file_path, source in sources.items())
+    assert b'diff --git a/dir/module.py b/dir/module.py\n' in patch_path.read_bytes()
+    
+    subprocess.run(('git', 'apply', patch_path.__str__()), cwd=cwd.__str__(), check=True)
+    
+    assert (cwd / 'module.py').read_bytes() == b'x = 1\n'
+    assert (cwd / 'dir' / 'module.py').read_bytes() == b'import os\r\ny = [1, 2]\r\n'
+    assert meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, diff=True, diff_file=patch_path) is None
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_merge_all_files_in_few_meld_sessions_WHEN_batch_meld(cwd, monkeypatch):
+    (cwd / 'dir').mkdir()
+    files_paths = [cwd / f'module{i}.py' for i in range(12)] + [cwd / 'dir' / 'module.py']
+    for file_path in files_paths:
+        file_path.write_text('x=1\n')
+    meld_calls = []
+    
+    def meld_saving_first_tab(cmds_args, jobs=1, timeout=None):
+        args, = cmds_args
+        meld_calls.append(args)
+        # User saves the merged file only in the first tab
+        assert args[:2] == ('meld', '--diff') and Path(args[4]).read_text() == 'x = 1\n'
+        Path(args[3]).write_text(Path(args[4]).read_text())
+        return ['']
+    
+    monkeypatch.setattr(shutil, 'which', lambda cmd: cmd)
+    monkeypatch.setattr(meldformat, '_execute_cmds', meld_saving_first_tab)
+    monkeypatch.setattr(meldformat.Autopep8Formatter, 'lint_files', lambda self, files, setup_path, jobs: {})
+    
+    formatted_files_paths = meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, batch_meld=True)
+    
+    assert meld_calls.__len__() == 2
+    assert sum(args.count('--diff') for args in meld_calls) == files_paths.__len__()
+    assert any(arg.endswith(os.path.join('mirror', 'dir', 'module.py')) for args in meld_calls for arg in args)
+    assert formatted_files_paths.__len__() == 2
+    assert all(file_path.read_text() == 'x = 1\n' for file_path in formatted_files_paths)
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_remove_files_in_flight_WHEN_meld_fails(cwd, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(cwd / 'tmp'))
+    (cwd / 'tmp').mkdir()
+    for i in range(20):
+        (cwd / f'module{i}.py').write_text('x=1\n')
+    
+    monkeypatch.setattr(shutil, 'which', lambda cmd: cmd)
+    monkeypatch.setattr(meldformat, '_execute_cmds',
+                        lambda cmds_args, jobs=1, timeout=None: [meldformat.ExecuteCmdError('exit code 1', None)])
+    
+    with pytest.raises(meldformat.MeldError):
+        meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, jobs=2)
+    
+    assert list((cwd / 'tmp').iterdir()) == []
+    assert all((cwd / f'module{i}.py').read_text() == 'x=1\n' for i in range(20))
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_return_report_of_each_file_WHEN_with_report(cwd):
+    sources = {cwd / 'changed.py': 'x=1\n', cwd / 'unchanged.py': 'x = 1\n', cwd / 'linted.py': 'import os\n'}
+    for file_path, source in sources.items():
+        file_path.write_text(source)
+    
+    report = meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False, use_cache=True,
+                                   lint_backend=meldformat.LintBackend.IN_PROCESS, with_report=True)
+    results = {result.path: result for result in report.files}
+    
+    assert report.changed_files == [cwd / 'changed.py']
+    assert results[cwd / 'changed.py'].status == meldformat.FileStatus.CHANGED
+    assert (results[cwd / 'changed.py'].bytes_before, results[cwd / 'changed.py'].bytes_after) == (4, 6)
+    assert results[cwd / 'unchanged.py'].status == meldformat.FileStatus.UNCHANGED
+    assert 'F401' in results[cwd / 'linted.py'].lint_findings[0]
+    totals = report.get_totals()
+    assert (totals['files'], totals['changed'], totals['unchanged'], totals['lint_findings']) == (3, 1, 2, 1)
+    assert json.loads(report.to_json())['totals'] == totals
+    
+    report = meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False, use_cache=True,
+                                   with_report=True)
+    
+    assert all(result.status == meldformat.FileStatus.SKIPPED for result in report.files)
+    assert meldformat.main([str(cwd), '--no-meld', '--report', str(cwd / 'report.ndjson')]) == 0
+    assert [json.loads(line)['path'] for line in (cwd / 'report.ndjson').read_text().splitlines()] == \
+        [str(file_path) for file_path in sorted(sources)]
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_call_hooks_for_each_phase_span_WHEN_hooks_given(cwd, capsys):
+    files_paths = [cwd / 'module.c', cwd / 'formatted.c']
+    files_paths[0].write_text('int  x=1;\n')
+    files_paths[1].write_text('int x = 1;\n')
+    spans = []
+    
+    class RecordingHooks(meldformat.InstrumentationHooks):
+        def span_started(self, phase, file_path):
+            spans.append(('start', phase, file_path))
+        
+        def span_ended(self, phase, file_path, elapsed_time):
+            assert elapsed_time >= 0.0
+            spans.append(('end', phase, file_path))
+    
+    timing_collector = meldformat.TimingCollector()
+    meldformat.format_dir(meldformat.Formatter.CLANGFORMAT, cwd, with_meld=False,
+                          hooks=(RecordingHooks(), timing_collector))
+    
+    assert [span for span in spans if span[0] == 'start'].__len__() == spans.__len__() / 2
+    assert ('end', meldformat.Phase.DISCOVER, None) in spans
+    assert all(('end', meldformat.Phase.FORMAT, file_path) in spans for file_path in files_paths)
+    assert all(('end', meldformat.Phase.COMPARE, file_path) in spans for file_path in files_paths)
+    assert [span[2] for span in spans if span[1] == meldformat.Phase.WRITE] == [files_paths[0]] * 2
+    assert sorted(file_path for file_path, _ in timing_collector.get_slowest_files(2)) == sorted(files_paths)
+    
+    timing_collector.print_summary(1)
+    
+    assert 'compare' in capsys.readouterr().out
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_keep_only_files_in_flight_in_temp_dir_WHEN_formatting_many_files(cwd, monkeypatch):
+    temp_dir_path = cwd / 'temp'
+    temp_dir_path.mkdir()
+    (cwd / 'src').mkdir()
+    for i in range(100):
+        (cwd / 'src' / f'module{i}.c').write_text('int  x=1;\n')
+        (cwd / 'src' / f'module{i}.py').write_text('x = 1\n')
+    temp_files_counts = []
+    
+    class TempFilesCounter(meldformat.InstrumentationHooks):
+        def span_started(self, phase, file_path):
+            if phase == meldformat.Phase.COMPARE:
+                temp_files_counts.append(sum(1 for temp_path in temp_dir_path.rglob('*') if temp_path.is_file()))
+    
+    monkeypatch.setattr(tempfile, 'tempdir', temp_dir_path.__str__())
+    monkeypatch.setattr(shutil, 'which', lambda cmd: cmd)
+    monkeypatch.setattr(meldformat.Autopep8Formatter, 'lint_files', lambda self, files, setup_path, jobs: {})
+    
+    meldformat.format_dir(meldformat.Formatter.CLANGFORMAT, cwd / 'src', with_meld=False, jobs=1,
+                          hooks=(TempFilesCounter(),))
+    
+    assert temp_files_counts.__len__() == 100 and max(temp_files_counts) < 50
+    assert all((cwd / 'src' / f'module{i}.c').read_text() == 'int x = 1;\n' for i in range(100))
+    
+    meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd / 'src', jobs=2)
+    
+    assert list(temp_dir_path.iterdir()) == []
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_lint_in_batches_without_file_records_WHEN_report_not_requested(cwd, monkeypatch):
+    files_paths = [cwd / f'module{i}.py' for i in range(5)]
+    for file_path in files_paths:
+        file_path.write_text('x=1\n')
+    linted_batches = []
+    
+    def no_records(self, file_path):
+        raise AssertionError('File record built')
+    
+    def lint_files(self, files, setup_path, jobs):
+        linted_batches.append(list(files))
+        return {file: [] for file in files}
+    
+    monkeypatch.setattr(meldformat, 'MAX_LINT_BATCH_SIZE', 2)
+    monkeypatch.setattr(meldformat.FormatReport, 'add_file', no_records)
+    monkeypatch.setattr(meldformat.Autopep8Formatter, 'lint_files', lint_files)
+    
+    assert meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False, jobs=1) == files_paths
+    assert linted_batches == [files_paths[:2], files_paths[2:4], files_paths[4:]]
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_replace_files_atomically_keeping_mode_WHEN_without_meld(cwd, monkeypatch):
+    files_paths = [cwd / 'module.py', cwd / 'module.c']
+    files_paths[0].write_text('x=1\n')
+    files_paths[1].write_text('int  x=1;\n')
+    for file_path in files_paths:
+        file_path.chmod(0o754)
+    monkeypatch.setattr(meldformat.Autopep8Formatter, 'lint_files', lambda self, files, setup_path, jobs: {})
+    
+    meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False, jobs=1)
+    meldformat.format_dir(meldformat.Formatter.CLANGFORMAT, cwd, with_meld=False, jobs=1)
+    
+    assert [file_path.read_text() for file_path in files_paths] == ['x = 1\n', 'int x = 1;\n']
+    assert all(stat.S_IMODE(file_path.stat().st_mode) == 0o754 for file_path in files_paths)
+    assert sorted(cwd.iterdir()) == sorted(files_paths)
+    
+    def failing_fsync(fd):
+        raise OSError('Disk full')
+    
+    files_paths[0].write_text('y=2\n')
+    monkeypatch.setattr(os, 'fsync', failing_fsync)
+    meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd, with_meld=False, jobs=1)
+    
+    assert files_paths[0].read_text() == 'y=2\n'
+    assert sorted(cwd.iterdir()) == sorted(files_paths)
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_replace_link_target_and_keep_link_WHEN_file_is_symbolic_link(cwd, monkeypatch):
+    (cwd / 'real').mkdir()
+    (cwd / 'src').mkdir()
+    files_paths = [cwd / 'real' / 'module.py', cwd / 'real' / 'module.c']
+    files_paths[0].write_text('x=1\n')
+    files_paths[1].write_text('int  x=1;\n')
+    links_paths = [cwd / 'src' / 'link.py', cwd / 'src' / 'link.c']
+    for link_path, file_path in zip(links_paths, files_paths):
+        link_path.symlink_to(file_path)
+    monkeypatch.setattr(meldformat.Autopep8Formatter, 'lint_files', lambda self, files, setup_path, jobs: {})
+    
+    meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd / 'src', with_meld=False, jobs=1)
+    meldformat.format_dir(meldformat.Formatter.CLANGFORMAT, cwd / 'src', with_meld=False, jobs=1)
+    
+    assert [file_path.read_text() for file_path in files_paths] == ['x = 1\n', 'int x = 1;\n']
+    assert all(link_path.is_symlink() for link_path in links_paths)
+    assert sorted(path.name for path in (cwd / 'real').iterdir()) == ['module.c', 'module.py']
+
+
+@pytest.mark.skipif(RUN_ALL_TESTS == False, reason='Skipped on demand')
+def test_format_dir_SHOULD_report_lint_failure_and_not_cache_files_WHEN_linter_run_fails(cwd, monkeypatch):
+    (cwd / 'src').mkdir()
+    file_path = cwd / 'src' / 'module.py'
+    file_path.write_text('import os\n')
+    linter_path = cwd / 'flake8'
+    linter_path.write_text('#!/bin/sh\n[ "$1" = "--version" ] && echo 1.0 && exit 0\n'
+                           'echo "Traceback (most recent call last):"\n'
+                           'echo "ValueError: invalid literal for int()"\nexit 1\n')
+    linter_path.chmod(0o755)
+    monkeypatch.setattr(meldformat.Autopep8Formatter, 'linter',
+                        meldformat.SimpleNamespace(name='Flake8', cmd=linter_path.__str__()))
+    
+    report = meldformat.format_dir(meldformat.Formatter.AUTOPEP8, cwd / 'src', with_meld=False, use_cache=True,
+                                   with_report=True)
+    
+    result, = report.files
+    assert result.status == meldformat.FileStatus.FAILED and 'ValueError' in result.error
+    assert not meldformat._LintCache(cwd / 'src' / meldformat.LINT_CACHE_FILE_NAME, meldformat.Autopep8Formatter(),
+                                     None).is_clean(file_path)